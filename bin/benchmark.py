@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the OCR pipeline.
+
+Compare OCR backends on a set of already-extracted regions:
+
+$ benchmark.py ocr -b shell -b batch /var/ccsd-scripts/regions/00/*/*.tiff
+
+Check that montage OCR reads every region of a year/type's schools
+the same as per-region OCR does, listing any that differ (run from a
+year/type directory):
+
+$ benchmark.py montage -c ../../config/hs.2011-12.ini -n 5
+
+Measure, per school, what the optional region store costs compared
+with keeping crops in memory, and what handing a batch of crops to
+tesseract costs as one in-memory multi-page TIFF compared with
+spooling each crop to disk (run from a year/type directory):
+
+$ benchmark.py regions -c ../../config/hs.2011-12.ini -n 5
+
+Compare `make tiff` with rendering PDF pages (or just the configured
+part of them) straight to memory:
+
+$ benchmark.py raster -c ../../config/hs.2011-12.ini -j 4 pdf/*.pdf
+
+Time extract_information.py's bbox matching per page on the pdfminer
+XML fixtures:
+
+$ benchmark.py match -c es-config.ini xml/ES/*.xml
+
+Run every stage end to end on synthetic schools -- pages with made up
+values drawn at a config's coordinates, plus pdfminer-style XML --
+with an in-memory OCR cache and Mongo collection standing in for
+Redis and MongoDB, so it needs nothing but tesseract:
+
+$ benchmark.py suite -c config/hs.2011-12.ini -n 5
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from collections import defaultdict, OrderedDict
+from ocr_backend import BACKENDS, get_backend
+
+def bench_ocr(args):
+    regions = args.regions[:args.limit] if args.limit else args.regions
+    names = args.backend or ['shell', 'batch']
+    results = {}
+
+    for name in names:
+        backend = get_backend(name)
+        start = time.time()
+        results[name] = backend.ocr(regions)
+        elapsed = time.time() - start
+        print("%-10s %6d regions %8.2fs %8.1f regions/sec" % (
+            name, len(regions), elapsed, len(regions) / elapsed))
+
+    # Every backend should agree with the first one we ran.
+    for name in names[1:]:
+        mismatches = sum(1 for (a, b) in zip(results[names[0]], results[name])
+                         if a != b)
+        if mismatches:
+            print("%s disagrees with %s on %d regions" % (name, names[0], mismatches))
+
+def bench_montage(args):
+    import ocr_pdf
+    from region_plan import load_plan
+
+    plan = load_plan(args.config)
+    reference = get_backend(args.reference)
+    montage = get_backend('montage')
+    (regions, mismatches, times) = (0, 0, {'reference': 0.0, 'montage': 0.0})
+    # Name each box after the first category that reads it.
+    labels = {(page, box): categories[0][1]
+              for (page, boxes) in plan.pages.iteritems()
+              for (box, categories) in boxes}
+
+    for (school, tiff_files) in sorted(ocr_pdf.get_tiff_files(args.tiff))[:args.limit]:
+        boxes = list(plan.boxes())
+        crops = [ocr_pdf.extract_region(tiff_files[page], box) for (page, box) in boxes]
+
+        start = time.time()
+        expected = reference.ocr(crops)
+        times['reference'] += time.time() - start
+        start = time.time()
+        got = montage.ocr(crops)
+        times['montage'] += time.time() - start
+
+        for ((page, box), a, b) in zip(boxes, expected, got):
+            if a != b:
+                mismatches += 1
+                print("%s page %d %r (%s): %r != %r" % (
+                    school, page, box, labels[(page, box)], a, b))
+        regions += len(boxes)
+
+    print("montage matches %s on %d of %d regions; %.2fs vs %.2fs" % (
+        args.reference, regions - mismatches, regions,
+        times['montage'], times['reference']))
+    return 1 if mismatches else 0
+
+def du(root):
+    """
+    Return (files, directories, bytes) under `root`.
+    """
+    (files, dirs, size) = (0, 0, 0)
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirs += len(dirnames)
+        files += len(filenames)
+        size += sum(os.path.getsize(os.path.join(dirpath, fn)) for fn in filenames)
+    return (files, dirs, size)
+
+def bench_regions(args):
+    import ocr_pdf
+    from ocr_backend import encode_images
+    from region_plan import load_plan
+
+    plan = load_plan(args.config)
+    schools = sorted(ocr_pdf.get_tiff_files(args.tiff))[:args.limit]
+
+    for (school, tiff_files) in schools:
+        boxes = [(tiff_files[page], box) for (page, box) in plan.boxes()]
+
+        start = time.time()
+        crops = [ocr_pdf.extract_region(image, coordinates)
+                 for (image, coordinates) in boxes]
+        in_memory = time.time() - start
+
+        store = tempfile.mkdtemp(prefix='ccsd-regions-')
+        try:
+            start = time.time()
+            for (image, coordinates) in boxes:
+                ocr_pdf.extract_region(image, coordinates, store)
+            on_disk = time.time() - start
+            (files, dirs, size) = du(store)
+        finally:
+            shutil.rmtree(store, ignore_errors=True)
+
+        start = time.time()
+        data = encode_images(crops) if crops else ''
+        piped = time.time() - start
+
+        spool = tempfile.mkdtemp(prefix='ccsd-spool-')
+        try:
+            start = time.time()
+            for (n, crop) in enumerate(crops):
+                crop.save(os.path.join(spool, '%d.tiff' % n))
+            spooled = time.time() - start
+            spool_size = du(spool)[2]
+        finally:
+            shutil.rmtree(spool, ignore_errors=True)
+
+        print("%-40s %4d regions  crop %6.2fs  store %6.2fs "
+              "(%d files, %d dirs, %.1f KiB)" % (
+                  school[:40], len(boxes), in_memory, on_disk,
+                  files, dirs, size / 1024.0))
+        if data is None:
+            print("%-40s batch: this PIL can't write multi-page TIFFs, "
+                  "so every crop is spooled to disk" % '')
+        else:
+            print("%-40s batch: stdin %6.2fs (%.1f KiB)  spooled %6.2fs "
+                  "(%d files, %.1f KiB)" % (
+                      '', piped, len(data) / 1024.0, spooled,
+                      len(crops), spool_size / 1024.0))
+
+def raster_tiff(pdf):
+    """
+    Render every page of `pdf` to TIFFs the way pdf-to-tiff.sh does and
+    return the bytes written.
+    """
+    tmp = tempfile.mkdtemp(prefix='ccsd-tiff-')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['gs', '-o', os.path.join(tmp, 'page_%02d.tiff'),
+                                   '-sDEVICE=tiffgray', '-r720x720',
+                                   '-sCompression=lzw', pdf], stdout=devnull)
+        return du(tmp)[2]
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def raster_memory(job):
+    import rasterise
+    (pdf, clips, clip) = job
+    for (page, box) in sorted(clips.iteritems()):
+        if clip:
+            rasterise.render_clip(pdf, page, box).load()
+        else:
+            rasterise.render_page(pdf, page).load()
+    return 0
+
+def bench_raster(args):
+    import ocr_pdf
+    from region_plan import load_plan
+
+    pdfs = args.pdfs[:args.limit] if args.limit else args.pdfs
+    clips = ocr_pdf.page_clips(load_plan(args.config))
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    run = pool.map if pool else map
+
+    modes = [
+        ('make tiff', raster_tiff, pdfs),
+        ('gs to memory', raster_memory, [(pdf, clips, False) for pdf in pdfs]),
+        ('pdftoppm clip', raster_memory, [(pdf, clips, True) for pdf in pdfs]),
+    ]
+    for (name, func, jobs) in modes:
+        start = time.time()
+        written = sum(run(func, jobs))
+        elapsed = time.time() - start
+        print("%-14s %4d PDFs %8.2fs %8.2fs/PDF %10.1f MiB on disk" % (
+            name, len(pdfs), elapsed, elapsed / len(pdfs),
+            written / (1024.0 * 1024.0)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def process_page_scan(page):
+    """
+    The straightforward version of process_page: try every config
+    location against every textbox. The reference the tests and the
+    `match` benchmark check it against.
+    """
+    from extract_information import create_boundaries, parse_bbox, extract_text
+
+    ret = {}
+    keys_seen = set()
+    config = [(category, create_boundaries(location))
+              for category, location in page['config']]
+    for textbox in page['page']:
+        bbox = parse_bbox(textbox.attrib['bbox'])
+        for category, boundaries in config:
+            keys_seen.add(category)
+            match = boundaries.match(bbox)
+            if match and category not in ret:
+                ret[category] = extract_text(textbox, category)
+
+    missing_keys = keys_seen - set(ret.keys())
+    for missing_key in missing_keys:
+        ret[missing_key] = '*** Missing value ***'
+
+    return ret
+
+def bench_match(args):
+    from lxml import etree
+    from ConfigParser import SafeConfigParser
+    import extract_information
+
+    config = SafeConfigParser()
+    config.optionxform = lambda value: value
+    config.read([args.config])
+
+    pages = []
+    for fname in args.xml:
+        doc = etree.parse(fname)
+        for n in ('1', '2', '3'):
+            pages.append(dict(config=config.items('p' + n),
+                              page=doc.xpath("//page[@id='%s']//textbox" % n)))
+
+    for (name, func) in [('scan', process_page_scan),
+                         ('matcher', extract_information.process_page)]:
+        start = time.time()
+        for _ in xrange(args.repeat):
+            for page in pages:
+                func(page)
+        elapsed = (time.time() - start) / args.repeat
+        print("%-6s %4d pages %8.3fs %8.3fms/page" % (
+            name, len(pages), elapsed, 1000 * elapsed / len(pages)))
+
+class FakeCollection(object):
+    """
+    Just enough of a pymongo collection, kept in a dict, for
+    ingest.BulkWriter and create_csv.iter_groups.
+    """
+    def __init__(self):
+        self.documents = OrderedDict()
+
+    def ensure_index(self, keys, **kwargs):
+        pass
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulkOperation(self)
+
+    def aggregate(self, pipeline):
+        # Only understands the $match and $group create_csv sends.
+        match = pipeline[0]['$match']
+        groups = defaultdict(list)
+        for document in self.documents.itervalues():
+            if (document['year'] == match['year']
+                    and document['school']['type'] == match['school.type']):
+                groups[(document['section'], document['school']['name'])].append(
+                    {'category': document['category'], 'value': document['value']})
+        return [{'_id': {'section': section, 'school': school}, 'values': values}
+                for ((section, school), values) in sorted(groups.iteritems())]
+
+class FakeBulkOperation(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, query):
+        self.query = tuple(sorted(query.iteritems()))
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self, document):
+        self.ops.append((self.query, document))
+
+    def remove_one(self):
+        self.ops.append((self.query, None))
+
+    def execute(self):
+        for (key, document) in self.ops:
+            if document is None:
+                self.collection.documents.pop(key, None)
+            else:
+                self.collection.documents[key] = document
+
+SYNTHETIC_VALUES = ['{int}', '{int}', '{float}', '{pct}', 'Yes', 'No', 'N/A', '']
+
+def synthetic_value(rng):
+    value = rng.choice(SYNTHETIC_VALUES)
+    return value.format(int=rng.randint(0, 999),
+                        float='%.2f' % rng.uniform(0, 100),
+                        pct='%.1f%%' % rng.uniform(0, 100))
+
+def draw_value(page, box, text):
+    """
+    Draw `text` in the middle of the (x0, y0, x1, y1) box, scaled up
+    from PIL's bitmap font to roughly the size it is in the PDFs.
+    """
+    import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default()
+    (width, height) = font.getsize(text)
+    glyphs = Image.new('L', (width + 2, height + 2), 255)
+    ImageDraw.Draw(glyphs).text((1, 1), text, font=font, fill=0)
+
+    (x0, y0, x1, y1) = box
+    scale = min(0.8 * (x1 - x0) / glyphs.size[0], 0.6 * (y1 - y0) / glyphs.size[1])
+    size = (max(1, int(glyphs.size[0] * scale)), max(1, int(glyphs.size[1] * scale)))
+    glyphs = glyphs.resize(size)
+    page.paste(glyphs, ((x0 + x1 - size[0]) // 2, (y0 + y1 - size[1]) // 2))
+
+def make_schools(plan, root, count, rng):
+    """
+    Write `count` schools of synthetic pages under root/tiff, laid out
+    like pdf-to-tiff.sh's, and return {school: {(section, category):
+    value}} with what was drawn. Categories that share a box share its
+    value.
+    """
+    import Image
+
+    schools = OrderedDict()
+    for n in xrange(count):
+        school = '%03d-Synthetic School %d' % (900 + n, n)
+        directory = os.path.join(root, 'tiff', school)
+        os.makedirs(directory)
+        values = {}
+        for page in xrange(1, 5):
+            boxes = plan.pages.get(page, [])
+            size = (max([box[2] for (box, _) in boxes] or [100]) + 100,
+                    max([box[3] for (box, _) in boxes] or [100]) + 100)
+            im = Image.new('L', size, 255)
+            for (box, categories) in boxes:
+                value = synthetic_value(rng)
+                draw_value(im, box, value)
+                for pair in categories:
+                    values[pair] = value
+            im.save(os.path.join(directory, 'page_%02d.tiff' % page),
+                    compression='tiff_lzw')
+        schools[school] = values
+    return schools
+
+def make_xml(root, count, textboxes, rng):
+    """
+    Write `count` pdfminer-style XML files with `textboxes` textboxes
+    on each of pages 1-3, and return an extract_information config
+    locating a third of them.
+    """
+    from lxml import etree
+    from ConfigParser import SafeConfigParser
+
+    config = SafeConfigParser()
+    config.optionxform = lambda value: value
+    locations = {}
+    for page in ('1', '2', '3'):
+        config.add_section('p' + page)
+        locations[page] = []
+        for n in xrange(textboxes):
+            (x, y) = (rng.uniform(20, 560), rng.uniform(20, 760))
+            locations[page].append((x, y, x + rng.uniform(10, 60), y + 10))
+        for (n, (x0, y0, x1, y1)) in enumerate(locations[page][::3]):
+            config.set('p' + page, 'Category %s/%d' % (page, n),
+                       '%.3f,%.3f,%.3f,%.3f' % (x0, y0, x1, y1))
+
+    fnames = []
+    for n in xrange(count):
+        pages = etree.Element('pages')
+        for page in ('1', '2', '3', '4'):
+            elem = etree.SubElement(pages, 'page', id=page)
+            for (x0, y0, x1, y1) in locations.get(page, []):
+                # Jiggle every box a little, as in the real PDFs.
+                bbox = ','.join('%.3f' % (v + rng.uniform(-2, 2)) for v in (x0, y0, x1, y1))
+                textbox = etree.SubElement(elem, 'textbox', bbox=bbox)
+                textline = etree.SubElement(textbox, 'textline', bbox=bbox)
+                for char in str(rng.randint(0, 9999)):
+                    etree.SubElement(textline, 'text', bbox=bbox).text = char
+        fname = os.path.join(root, '%03d-Synthetic School %d.xml' % (900 + n, n))
+        etree.ElementTree(pages).write(fname)
+        fnames.append(fname)
+    return (config, fnames)
+
+def peak_rss():
+    """
+    Return the peak resident set size, in MiB, of this process and of
+    its largest child (tesseract).
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+
+def bench_suite(args):
+    from lxml import etree
+    import ocr_pdf
+    import create_csv
+    import extract_information
+    import instrument
+    from ingest import BulkWriter
+    from ocr_cache import MemoryCache
+    from region_plan import load_plan
+
+    rng = random.Random(args.seed)
+    plan = load_plan(args.config)
+    backend = get_backend(args.ocr)
+    cache = MemoryCache()
+    collection = FakeCollection()
+    root = tempfile.mkdtemp(prefix='ccsd-bench-')
+    # process_school takes the school type from a /hs/ in the path.
+    directory = os.path.join(root, 'hs')
+    timings = OrderedDict((stage, [0.0, 0]) for stage in (
+        'ocr', 'csv', 'match', 'xml'))
+
+    def timed(stage, count, func, *a):
+        start = time.time()
+        result = func(*a)
+        timings[stage][0] += time.time() - start
+        timings[stage][1] += count
+        return result
+
+    try:
+        print("Generating %d synthetic schools in %s" % (args.schools, directory))
+        schools = make_schools(plan, directory, args.schools, rng)
+        (xml_config, xml_files) = make_xml(root, args.schools, args.textboxes, rng)
+
+        # The same path ocr_pdf.py takes for each school: blank
+        # skipping, shared boxes, page grouping and batched OCR, timed
+        # by its own instrument stages.
+        instrument.collect()
+        regions = 0
+        correct = 0
+        with BulkWriter(collection) as writer:
+            for (school, tiff_files) in sorted(ocr_pdf.get_tiff_files(
+                    os.path.join(directory, 'tiff'))):
+                documents = timed('ocr', 1, lambda: ocr_pdf.process_school(
+                    school, tiff_files, plan, backend, cache, year='synthetic'))
+                for document in documents:
+                    key = (document['section'], document['category'])
+                    if key in schools[school]:
+                        regions += 1
+                        correct += document['value'] == schools[school][key]
+                writer.extend(documents)
+        stats = instrument.collect()
+
+        output = os.path.join(root, 'synthetic.csv')
+        timed('csv', args.schools, lambda: create_csv.write_combined_csv(
+            create_csv.iter_groups('High', 'synthetic', collection),
+            plan, output))
+
+        for fname in xml_files:
+            doc = etree.parse(fname)
+            pages = [dict(config=xml_config.items('p' + n),
+                          page=doc.xpath("//page[@id='%s']//textbox" % n))
+                     for n in ('1', '2', '3')]
+            timed('match', len(pages), lambda: map(extract_information.process_page, pages))
+            timed('xml', 1, extract_information.extract_from_pdf, fname, xml_config)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    for (stage, seconds) in sorted(stats.seconds.iteritems()):
+        print("%-12s %8.3fs %7d calls" % (stage, seconds, stats.calls[stage]))
+    units = {'ocr': 'schools', 'csv': 'schools', 'match': 'pages', 'xml': 'files'}
+    for (stage, (elapsed, count)) in timings.iteritems():
+        print("%-12s %8.3fs %7d %-8s %10.1f/sec" % (
+            stage, elapsed, count, units[stage], count / elapsed if elapsed else 0))
+    print("Regions: %d cache hits, %d misses, %d blank, %d shared boxes" % (
+        stats['cache_hits'], stats['cache_misses'], stats['blank_regions'],
+        stats['duplicate_boxes']))
+
+    elapsed = timings['ocr'][0]
+    total = elapsed + stats.seconds['mongo_write'] + timings['csv'][0]
+    print("OCR: %.1f regions/sec, %.1f schools/min; %d of %d regions read back correctly" % (
+        regions / elapsed, 60 * args.schools / total, correct, regions))
+    print("Peak RSS: %.1f MiB, %.1f MiB for the largest child" % peak_rss())
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    ocr = subparsers.add_parser('ocr', help='compare OCR backends')
+    ocr.add_argument('regions', nargs='+', metavar='TIFF')
+    ocr.add_argument('-b', '--backend', action='append', choices=sorted(BACKENDS))
+    ocr.add_argument('-n', '--limit', type=int)
+    ocr.set_defaults(func=bench_ocr)
+
+    montage = subparsers.add_parser('montage', help='validate montage OCR against per-region OCR')
+    montage.add_argument('-c', '--config', required=True)
+    montage.add_argument('-t', '--tiff', default='tiff')
+    montage.add_argument('-n', '--limit', type=int)
+    montage.add_argument('-r', '--reference', choices=sorted(BACKENDS), default='batch')
+    montage.set_defaults(func=bench_montage)
+
+    regions = subparsers.add_parser('regions', help='region I/O per school')
+    regions.add_argument('-c', '--config', required=True)
+    regions.add_argument('-t', '--tiff', default='tiff')
+    regions.add_argument('-n', '--limit', type=int)
+    regions.set_defaults(func=bench_regions)
+
+    raster = subparsers.add_parser('raster', help='TIFFs versus in-memory rendering')
+    raster.add_argument('pdfs', nargs='+', metavar='PDF')
+    raster.add_argument('-c', '--config', required=True)
+    raster.add_argument('-j', '--jobs', type=int, default=1)
+    raster.add_argument('-n', '--limit', type=int)
+    raster.set_defaults(func=bench_raster)
+
+    match = subparsers.add_parser('match', help='bbox matching per page')
+    match.add_argument('xml', nargs='+', metavar='XML')
+    match.add_argument('-c', '--config', required=True)
+    match.add_argument('-r', '--repeat', type=int, default=3)
+    match.set_defaults(func=bench_match)
+
+    suite = subparsers.add_parser('suite', help='every stage on synthetic schools, offline')
+    suite.add_argument('-c', '--config', required=True)
+    suite.add_argument('-n', '--schools', type=int, default=3)
+    suite.add_argument('-b', '--ocr', choices=sorted(BACKENDS), default='batch')
+    suite.add_argument('-t', '--textboxes', type=int, default=300,
+                       help='textboxes per page of synthetic XML')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
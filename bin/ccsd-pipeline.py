@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+OCR and export several year/type reports in one process.
+
+`make all` runs ocr_pdf.py and create_csv.py once per year and type,
+so every one of them starts Python, parses its config, connects to
+Mongo and the OCR cache and spins up its own worker pool. This does
+the same work in one go:
+
+$ bin/ccsd-pipeline.py -j 8 2010-11/es 2011-12/hs
+
+Each JOB is a year/type directory; its config is config/TYPE.YEAR.ini
+and its CSV is written to YEAR/TYPE.csv, exactly where the Makefile
+puts them (or YEAR/TYPE.tsv.gz with --format tsv.gz). The OCR backend, cache, Mongo connection and worker pool
+(along with each worker's decoded pages) are shared by every job, and
+every job's schools are queued up front so the pool moves straight on
+to the next job while the previous one is being written out.
+"""
+
+import os
+import argparse
+import multiprocessing
+from itertools import imap
+
+import create_csv
+import instrument
+import manifest
+import ocr_pdf
+from ocr_backend import get_backend
+from ocr_cache import open_cache
+from region_plan import load_plan
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHOOL_TYPES = {
+    'es': 'Elementary',
+    'ms': 'Middle',
+    'hs': 'High',
+}
+
+DEFAULT_JOBS = ['%s/%s' % (year, school_type)
+                for year in ('2010-11', '2011-12')
+                for school_type in ('es', 'ms', 'hs')]
+
+def parse_job(job, root=ROOT, format='csv'):
+    """
+    >>> job = parse_job('2011-12/hs', '/ccsd')
+    >>> (job['school_type'], job['config'], job['output'])
+    ('High', '/ccsd/config/hs.2011-12.ini', '/ccsd/2011-12/hs.csv')
+    >>> parse_job('2011-12/hs', '/ccsd', 'tsv.gz')['output']
+    '/ccsd/2011-12/hs.tsv.gz'
+    """
+    (year, school_type) = job.strip('/').split('/')
+    if school_type not in SCHOOL_TYPES:
+        raise ValueError('unknown school type in %r' % job)
+    return {
+        'year': year,
+        'type': school_type,
+        'school_type': SCHOOL_TYPES[school_type],
+        'config': os.path.join(root, 'config', '%s.%s.ini' % (school_type, year)),
+        'directory': os.path.join(root, year, school_type),
+        'output': os.path.join(root, year, '%s.%s' % (
+            school_type, create_csv.EXTENSIONS[format])),
+    }
+
+def main(args):
+    jobs = [parse_job(job, args.root, args.format) for job in args.job or DEFAULT_JOBS]
+    backend = get_backend(args.ocr)
+    cache = open_cache(args.cache)
+    ocr_pdf.PAGE_CACHE.max_bytes = args.page_cache_mb * 1024 * 1024
+
+    # Plan every job before the pool forks so the workers inherit all
+    # of their region plans.
+    for job in jobs:
+        job['plan'] = load_plan(job['config'], args.plan_dir)
+        if args.clean:
+            ocr_pdf.remove_existing_documents(job['config'], job['year'],
+                                              job['school_type'])
+        if args.source == 'pdf' and args.clip:
+            ocr_pdf.page_clips(job['plan'], ocr_pdf.PAGE_CLIPS)
+
+        job['state'] = manifest.Manifest(os.path.join(
+            job['directory'], manifest.default_path(job['config'])))
+        (job['schools'], job['removed'], job['entries']) = ocr_pdf.plan_schools(
+            job['plan'], ocr_pdf.get_sources(args.source, job['directory']),
+            job['state'], job['year'], args.school, args.force or args.clean,
+            ocr_pdf.extraction_settings(args))
+        ocr_pdf.WORKER_OPTIONS[job['config']] = ocr_pdf.worker_options(
+            args, job['plan'], job['year'], backend, cache)
+        print("%s/%s: %d of %d schools need extracting" % (
+            job['year'], job['type'], len(job['schools']), len(job['entries'])))
+        ocr_pdf.report_boxes(job['config'], job['plan'])
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        mapper = pool.imap
+    else:
+        pool = None
+        mapper = imap
+    for job in jobs:
+        job['results'] = mapper(ocr_pdf._process_school_worker,
+                                [(job['config'],) + item for item in job['schools']])
+
+    total = instrument.Stats()
+    peak_bytes = 0
+    for job in jobs:
+        print("Writing %s/%s" % (job['year'], job['type']))
+        progress = instrument.Progress(len(job['schools'])) if args.progress else None
+        (stats, page_cache_peak_bytes) = ocr_pdf.write_documents(
+            job['results'], job['removed'], args.batch_size, progress)
+        total.update(stats)
+        peak_bytes = max(peak_bytes, page_cache_peak_bytes)
+        for (school, entry) in job['entries'].iteritems():
+            job['state'].update(school, entry)
+        job['state'].save()
+        ocr_pdf.report_stats(stats, page_cache_peak_bytes)
+
+        create_csv.write_csv(argparse.Namespace(
+            config=job['config'], school_type=job['school_type'],
+            year=job['year'], output=job['output'], format=args.format),
+            job['plan'])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    total.update(instrument.collect())
+    ocr_pdf.write_summary(total, peak_bytes, args.stats)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('job', nargs='*', metavar='YEAR/TYPE',
+                        help='e.g. 2011-12/hs (default: every year and type)')
+    parser.add_argument('--root', default=ROOT,
+                        help='the checkout holding config/ and the year '
+                             'directories (default: %(default)s)')
+    parser.add_argument('--format', choices=sorted(create_csv.WRITERS),
+                        default='csv', help='see create_csv.py --format')
+    ocr_pdf.add_arguments(parser)
+    main(parser.parse_args())
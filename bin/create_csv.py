@@ -1,83 +1,218 @@
 #!/usr/bin/env python
 
+import os
 import re
-import tablib
+import csv
+import gzip
+import shutil
 import pymongo
 import operator
-from ocr_pdf import build_config, get_current_year
-from collections import defaultdict
-import decimal
-
-conn = pymongo.Connection()
-db = conn.ccsd
-ccsd = db.ccsd
-
-def get_section(school_type, section):
-    return ccsd.find({
-        'school.type': school_type,
-        'section': section,
-        'year': get_current_year(),
-    })
-
-def section_to_dict(it):
-    ret = defaultdict(dict)
-    for item in it:
-        school = item.get('school')
-        school_name = school.get('name')
-        category = item.get('category')
-        value = item.get('value')
-        ret[school_name][category] = value
-    return ret
-
-def get_compare_function(section, config):
-    lookup = config.options(section)
-
-    def _cmp(x, y):
-        x = lookup.index(x)
-        y = lookup.index(y)
-        return -1 if (x < y) else (1 if y > x else 0)
-
-    return _cmp
-
-def dict_to_dataset(ret, section, config):
-    data = tablib.Dataset()
-    compare_function = get_compare_function(section, config)
-
-    for school, categories in sorted(ret.iteritems(), key=operator.itemgetter(0)):
-        if not data.headers:
-            data.headers = ['School'] + sorted(categories.iterkeys(), cmp=compare_function)
-
-        row = [school]
-        for label, value in sorted(categories.iteritems(),
-                                   key=operator.itemgetter(0),
-                                   cmp=compare_function):
-            row.append(value)
-        data.append(row)
-    return data
-
-def write_csv(args):
-    config = build_config(args.config)
-    datasets = []
-
-    for section in config.sections():
-        it = get_section(args.school_type, section)
-        ret = section_to_dict(it)
-        dataset = dict_to_dataset(ret, section, config)
-        datasets.append(dataset)
-
-    with open(args.output, 'wb') as fp:
-        for dataset in datasets:
-            fp.write(dataset.csv + '\n')
-
-    return args.output
-
-def main():
+import itertools
+import tempfile
+from ocr_pdf import get_current_year, write_summary
+from region_plan import load_plan, PLAN_DIR
+from ingest import get_collection
+import instrument
+
+def ensure_indexes(collection):
+    collection.ensure_index([('year', pymongo.ASCENDING),
+                             ('school.type', pymongo.ASCENDING),
+                             ('section', pymongo.ASCENDING)])
+
+def aggregate(collection, pipeline):
+    """
+    Run an aggregation pipeline and return an iterable of results,
+    whichever shape this version of pymongo hands them back in.
+    """
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return result
+
+def iter_groups(school_type, year, collection=None):
+    """
+    Stream every value for a school type and year in one round trip.
+
+    Yields (section, school name, {category: value}) sorted by section
+    and then school, so callers can write each row as it arrives.
+    """
+    if collection is None:
+        collection = get_collection()
+    ensure_indexes(collection)
+
+    it = aggregate(collection, [
+        {'$match': {'year': year, 'school.type': school_type}},
+        {'$project': {'_id': 0, 'section': 1, 'category': 1, 'value': 1,
+                      'school': '$school.name'}},
+        {'$group': {'_id': {'section': '$section', 'school': '$school'},
+                    'values': {'$push': {'category': '$category',
+                                         'value': '$value'}}}},
+        {'$sort': {'_id.section': 1, '_id.school': 1}},
+    ])
+
+    for group in it:
+        yield (group['_id']['section'], group['_id']['school'],
+               {item['category']: item['value'] for item in group['values']})
+
+def get_column_positions(section, plan):
+    """
+    Return a section's categories in config order, along with a
+    {category: position} map for placing values in a row; both come
+    precomputed in the RegionPlan.
+    """
+    return (plan.columns[section], plan.positions[section])
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def make_row(school, categories, positions):
+    # Categories a school is missing stay blank rather than shifting
+    # the rest of the row over.
+    instrument.STATS['csv_rows'] += 1
+    row = [''] * len(positions)
+    for (category, value) in categories.iteritems():
+        if category in positions:
+            row[positions[category]] = encode(value)
+    return [encode(school)] + row
+
+def iter_sections(groups, plan):
+    """
+    Split a sorted stream of groups into (section, rows) pairs, leaving
+    out sections that aren't in the RegionPlan.
+    """
+    for (section, it) in itertools.groupby(groups, key=operator.itemgetter(0)):
+        if section not in plan.columns:
+            continue
+        (_, positions) = get_column_positions(section, plan)
+        yield (section, (make_row(school, categories, positions)
+                         for (_, school, categories) in it))
+
+def section_filename(output, section):
+    """
+    >>> section_filename('2011-12/hs.csv', '2-HSPE/Math')
+    '2011-12/hs.2-HSPE_Math.csv'
+    """
+    return '%s.%s.csv' % (os.path.splitext(output)[0],
+                          re.sub(r'[^\w.-]+', '_', section))
+
+def write_combined_csv(groups, plan, output):
+    """
+    Every section in one file, in config order, separated by a blank
+    line.
+
+    Mongo hands sections back sorted by name rather than in config
+    order, so each one is spooled to a temporary file as it streams
+    in and they're stitched together at the end.
+    """
+    spools = {}
+    for (section, rows) in iter_sections(groups, plan):
+        spools[section] = tempfile.TemporaryFile()
+        csv.writer(spools[section]).writerows(rows)
+
+    with open(output, 'wb') as fp:
+        writer = csv.writer(fp)
+        for section in plan.columns:
+            (columns, _) = get_column_positions(section, plan)
+            writer.writerow(['School'] + columns)
+            if section in spools:
+                spools[section].seek(0)
+                shutil.copyfileobj(spools[section], fp)
+                spools[section].close()
+            fp.write('\n')
+    return [output]
+
+def write_section_csvs(groups, plan, output):
+    """
+    One CSV per section, named after `output` (see section_filename).
+    """
+    outputs = []
+    written = set()
+    for (section, rows) in iter_sections(groups, plan):
+        outputs.append(write_section(section, rows, plan, output))
+        written.add(section)
+    for section in plan.columns:
+        if section not in written:
+            outputs.append(write_section(section, [], plan, output))
+    return outputs
+
+def write_section(section, rows, plan, output):
+    fn = section_filename(output, section)
+    (columns, _) = get_column_positions(section, plan)
+    with open(fn, 'wb') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['School'] + columns)
+        writer.writerows(rows)
+    return fn
+
+def write_tsv_gz(groups, plan, output):
+    """
+    One gzipped, tab separated file with a row per value:
+    section, school, category, value.
+    """
+    with gzip.open(output, 'wb') as fp:
+        writer = csv.writer(fp, dialect='excel-tab')
+        writer.writerow(['Section', 'School', 'Category', 'Value'])
+        for (section, school, categories) in groups:
+            if section not in plan.columns:
+                continue
+            (columns, _) = get_column_positions(section, plan)
+            writer.writerows([encode(section), encode(school), category,
+                              encode(categories[category])]
+                             for category in columns if category in categories)
+    return [output]
+
+WRITERS = {
+    'csv': write_combined_csv,
+    'csv-per-section': write_section_csvs,
+    'tsv.gz': write_tsv_gz,
+}
+
+# The extension each format's OUTPUT should have.
+EXTENSIONS = {
+    'csv': 'csv',
+    'csv-per-section': 'csv',
+    'tsv.gz': 'tsv.gz',
+}
+
+def write_csv(args, plan=None, collection=None):
+    """
+    Write a school type and year out in `args.format` and return the
+    files written. `plan` saves loading the RegionPlan for
+    `args.config` again.
+    """
+    if plan is None:
+        plan = load_plan(args.config, getattr(args, 'plan_dir', PLAN_DIR))
+    groups = iter_groups(args.school_type, args.year or get_current_year(),
+                         collection)
+    with instrument.timer('csv_export'):
+        return WRITERS[getattr(args, 'format', 'csv')](groups, plan, args.output)
+
+def get_parser():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--school-type')
     parser.add_argument('-c', '--config')
     parser.add_argument('-o', '--output')
-    write_csv(parser.parse_args())
+    parser.add_argument('-y', '--year',
+                        help='e.g. 2011-12 (default: taken from the current directory)')
+    parser.add_argument('-f', '--format', choices=sorted(WRITERS), default='csv',
+                        help='csv: every section in one file (default); '
+                        'csv-per-section: a file per section next to OUTPUT; '
+                        'tsv.gz: one row per value, gzipped')
+    parser.add_argument('--plan-dir', default=PLAN_DIR, metavar='DIR',
+                        help='where compiled configs are cached '
+                             '(default: %(default)s)')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write the JSON timing summary to FILE instead '
+                             'of printing it')
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    write_csv(args)
+    write_summary(instrument.collect(), path=args.stats)
 
 if __name__ == "__main__":
     main()
@@ -18,17 +18,47 @@ It ain't pretty, but it works.
 
 import re
 import tablib
+import multiprocessing
 from lxml import etree
+from collections import defaultdict
 from ConfigParser import SafeConfigParser
 
 DIGITS_ONLY = {'Academic Achievement', 'Other Indicators'}
 
-# Cache the compiled regexes under the `coord` key
-COMMON_BOUNDS = {}
+# Set by main() before the worker pool forks, so every worker shares
+# the config it parsed instead of reading it again.
+WORKER_CONFIG = None
+
+class Boundaries(object):
+    """
+    Fuzzy matching for a configured location; see create_boundaries.
+    """
+    def __init__(self, ranges):
+        # [(low, high), ...]: a point matches when low <= n < high.
+        self.ranges = ranges
+
+    def match(self, bbox):
+        """
+        Whether a parsed bbox (see parse_bbox) falls inside every range.
+        """
+        if len(bbox) != len(self.ranges):
+            return False
+        for (n, (low, high)) in zip(bbox, self.ranges):
+            if not low <= n < high:
+                return False
+        return True
+
+    def window(self):
+        """
+        Return the (x0, y0, x1, y1) window the bbox's bottom-left corner
+        has to fall in, for a WindowIndex.
+        """
+        ((x_low, x_high), (y_low, y_high)) = self.ranges[:2]
+        return (x_low, y_low, x_high, y_high)
 
 def create_boundaries(coord, default_size=10):
     """
-    Generate a coordinate matching regexp that can do "fuzzy matching."
+    Build a Boundaries that can do "fuzzy matching" against a location.
 
     The PDFs provided by CCSD are programatically generated, but the
     point locations for certain elements are not identical between
@@ -40,13 +70,9 @@ def create_boundaries(coord, default_size=10):
 
     Given the location point '663.000,313.440,699.454,323.989' we will
     take each whole number (e.g., 663, 313, 699, 323) and (by default)
-    create a range from [n-default_size, n+default_size] (inclusive).
-
-    We then '|'-join each number in the range so it becomes
-    essentially an OR statement.  So with a default_size=5, the above
-    coordinate point becomes:
-
-    r'(658\.\d{3}|659\.\d{3}|...|667\.\d{3}|668\.\d{3}),(308\.\d{3}...),...
+    accept anything whose whole number is within default_size of it.
+    So with a default_size=5, 663.000 matches anything from 658.000 up
+    to (but not including) 669.000.
 
     EXCEPT, sometimes a particular digit (e.g., 313) will need to be
     (way) larger than default_size but you don't want each digit
@@ -55,21 +81,101 @@ def create_boundaries(coord, default_size=10):
     In this case, after each digit's fractional part an optional ':N'
     can be supplied which will set that digit's "range."  For example:
     '663.000:10' will range between 653 and 673. When ':N' is omitted,
-    the digit uses the default_size.
+    the digit uses the default_size. N may be fractional: '663.000:2.5'
+    ranges from 660.5 up to 666.5.
     """
-    if coord in COMMON_BOUNDS:
-        result = COMMON_BOUNDS[coord]
-    else:
-        s = []
-        args = re.findall('(\d+)[.]\d{3}:?(\d*)', coord)
-        for arg, size in args:
-            size = int(size) if size else default_size
-            arg = int(arg)
-            result = '(' + '|'.join("%d\.\d{3}" % elem for elem in xrange(arg - size, arg + size + 1)) + ')'
-            s.append(result)
-        result = re.compile(','.join(s))
-        COMMON_BOUNDS[coord] = result
-    return result
+    return Boundaries([(arg - size, arg + size + 1)
+                       for arg, size in parse_location(coord, default_size)])
+
+def parse_location(coord, default_size=10):
+    """
+    Return the whole number and range of each point in a location.
+
+    >>> parse_location('663.000:20,313.440,699.454:2.5,323.989')
+    [(663, 20.0), (313, 10), (699, 2.5), (323, 10)]
+    """
+    return [(int(arg), float(size) if size else default_size)
+            for arg, size in re.findall('(\d+)[.]\d{3}(?::(\d+(?:[.]\d+)?))?', coord)]
+
+def parse_bbox(bbox):
+    """
+    >>> parse_bbox('663.000,313.440,699.454,323.989')
+    (663.0, 313.44, 699.454, 323.989)
+    """
+    return tuple(float(n) for n in bbox.split(','))
+
+class WindowIndex(object):
+    """
+    A coarse grid of buckets for finding which windows contain a point.
+
+    Each window goes into every bucket it overlaps, so a lookup only
+    has to check the windows in the point's own bucket instead of
+    every window on the page.
+    """
+    def __init__(self, cell_size=20):
+        self.cell_size = cell_size
+        self.buckets = defaultdict(list)
+
+    def cell(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def insert(self, item, x0, y0, x1, y1):
+        """
+        Add an item covering [x0, x1) x [y0, y1).
+        """
+        (cx0, cy0) = self.cell(x0, y0)
+        (cx1, cy1) = self.cell(x1, y1)
+        for cx in xrange(cx0, cx1 + 1):
+            for cy in xrange(cy0, cy1 + 1):
+                self.buckets[(cx, cy)].append((x0, y0, x1, y1, item))
+
+    def query(self, x, y):
+        """
+        Return the items whose window contains (x, y), in the order
+        they were added.
+        """
+        return [entry[4] for entry in self.buckets.get(self.cell(x, y), ())
+                if entry[0] <= x < entry[2] and entry[1] <= y < entry[3]]
+
+class PageMatcher(object):
+    """
+    Match one page's config against textboxes as they stream past.
+
+    Feed it the page's textboxes in document order; each category
+    takes the first textbox that matches it. Each config location goes
+    in a WindowIndex by the window its textbox's bottom-left corner has
+    to fall in, so a textbox is only run through the full
+    create_boundaries() match of the locations near it.
+    """
+    def __init__(self, config):
+        self.index = WindowIndex()
+        self.pending = set()
+        self.found = {}
+        self.seen_textbox = False
+        for category, location in config:
+            boundaries = create_boundaries(location)
+            self.index.insert((category, boundaries), *boundaries.window())
+            self.pending.add(category)
+
+    def feed(self, textbox):
+        self.seen_textbox = True
+        bbox = parse_bbox(textbox.attrib['bbox'])
+        for (category, boundaries) in self.index.query(bbox[0], bbox[1]):
+            if category in self.pending and boundaries.match(bbox):
+                self.found[category] = extract_text(textbox, category)
+                self.pending.discard(category)
+
+    def done(self):
+        return not self.pending
+
+    def result(self):
+        ret = dict(self.found)
+        # A page without any textboxes doesn't report its categories
+        # as missing.
+        if self.seen_textbox:
+            for category in self.pending:
+                ret[category] = '*** Missing value ***'
+        return ret
 
 def extract_text(textbox, category):
     """
@@ -80,39 +186,65 @@ def extract_text(textbox, category):
     return re.sub('[^\d.]+', '', s) if category in DIGITS_ONLY else s
 
 def process_page(page):
-    ret = {}
-    keys_seen = set()
+    """
+    Return {category: value} for every category configured for a page,
+    given its config and (already parsed) textboxes. This is the
+    PageMatcher extract_from_pdf streams textboxes into.
+    """
+    matcher = PageMatcher(page['config'])
     for textbox in page['page']:
-        for category, location in page['config']:
-            keys_seen.add(category)
-            match = create_boundaries(location).search(textbox.attrib['bbox'])
-            if match and category not in ret:
-                ret[category] = extract_text(textbox, category)
-
-    missing_keys = keys_seen - set(ret.keys())
-    for missing_key in missing_keys:
-        ret[missing_key] = '*** Missing value ***'
-
-    return ret
+        matcher.feed(textbox)
+        if matcher.done():
+            break
+    return matcher.result()
 
 def extract_from_pdf(fname, config):
     """
     Return a dictionary of {category: value} for a given school XML file.
+
+    pdfminer writes every character out as its own element, so rather
+    than loading the whole tree we stream through it: each <textbox>
+    is matched as soon as it's complete and then thrown away, along
+    with each page once we're past it. We stop reading as soon as
+    every category on pages 1-3 has been found.
     """
-    doc = etree.parse(fname)
     ret = {'School': re.search('\d\d\d-(.+)\.xml$', fname).group(1)}
 
-    pages = [
-        dict(config=config.items('p1'), page=doc.xpath("//page[@id='1']//textbox")),
-        dict(config=config.items('p2'), page=doc.xpath("//page[@id='2']//textbox")),
-        dict(config=config.items('p3'), page=doc.xpath("//page[@id='3']//textbox")),
-    ]
-
-    for page in pages:
-        ret.update(process_page(page))
+    matchers = {
+        '1': PageMatcher(config.items('p1')),
+        '2': PageMatcher(config.items('p2')),
+        '3': PageMatcher(config.items('p3')),
+    }
+    last_page = max(int(n) for n in matchers)
+
+    page_id = None
+    for (event, elem) in etree.iterparse(fname, events=('start', 'end')):
+        if elem.tag == 'page':
+            if event == 'start':
+                page_id = elem.get('id')
+                if int(page_id) > last_page:
+                    break
+            else:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        elif elem.tag == 'textbox' and event == 'end':
+            matcher = matchers.get(page_id)
+            if matcher is not None:
+                matcher.feed(elem)
+                if all(m.done() for m in matchers.itervalues()):
+                    break
+            elem.clear()
+
+    for matcher in matchers.itervalues():
+        ret.update(matcher.result())
 
     return ret
 
+def _extract_worker(fname):
+    print "Parsing '%s'..." % fname
+    return extract_from_pdf(fname, WORKER_CONFIG)
+
 def main():
     import argparse
     from operator import itemgetter
@@ -120,16 +252,28 @@ def main():
     parser.add_argument("input", nargs='+', metavar="XML")
     parser.add_argument("-c", "--config", required=True)
     parser.add_argument("-o", "--output", default="output.csv")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files to parse in parallel")
     args = parser.parse_args()
 
+    global WORKER_CONFIG
     output = tablib.Dataset()
     config = SafeConfigParser()
     config.optionxform = lambda value: value
     config.read([args.config])
+    WORKER_CONFIG = config
+
+    # Every file is independent. imap() hands results back in the
+    # order the files were given, so the output is the same however
+    # many jobs there are.
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(_extract_worker, args.input)
+    else:
+        pool = None
+        results = (_extract_worker(fname) for fname in args.input)
 
-    for fname in args.input:
-        print "Parsing '%s'..." % fname
-        info = extract_from_pdf(fname, config)
+    for info in results:
         values = []
 
         if not output.headers:
@@ -140,6 +284,10 @@ def main():
 
         output.append(values)
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     print "Writing to '%s'..." % args.output
     with open(args.output, 'wb') as fp:
         fp.write(output.csv)
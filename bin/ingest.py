@@ -0,0 +1,95 @@
+"""
+Write OCR'd documents into MongoDB.
+
+Documents are upserted on (school.id, year, section, category), so
+re-running a single school replaces just that school's values instead
+of needing the whole type/year wiped first. Writes go out as unordered
+bulk operations of `batch_size` documents rather than one insert per
+school.
+"""
+
+import pymongo
+
+import instrument
+
+# The fields that identify a document; see document_key().
+KEY_FIELDS = ('school.id', 'year', 'section', 'category')
+
+_client = None
+
+def get_collection():
+    """
+    Return the ccsd.ccsd collection, connecting on first use.
+    """
+    global _client
+    if _client is None:
+        _client = pymongo.MongoClient()
+    return _client.ccsd.ccsd
+
+def document_key(document):
+    """
+    Return the upsert query for a document.
+    """
+    return {
+        'school.id': document['school']['id'],
+        'year': document['year'],
+        'section': document['section'],
+        'category': document['category'],
+    }
+
+class BulkWriter(object):
+    """
+    Buffer documents and upsert them in unordered bulk writes.
+
+    Use it as a context manager so the final partial batch is flushed:
+
+        with BulkWriter(get_collection()) as writer:
+            for document in documents:
+                writer.add(document)
+    """
+    def __init__(self, collection, batch_size=1000):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+        self.collection.ensure_index([(field, pymongo.ASCENDING)
+                                      for field in KEY_FIELDS])
+
+    def add(self, document):
+        self.pending.append(('upsert', document))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def remove(self, key):
+        """
+        Queue the removal of the document matching `key` (see
+        document_key).
+        """
+        self.pending.append(('remove', key))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def extend(self, documents):
+        for document in documents:
+            self.add(document)
+
+    def flush(self):
+        if not self.pending:
+            return
+        with instrument.timer('mongo_write'):
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for (op, document) in self.pending:
+                if op == 'upsert':
+                    bulk.find(document_key(document)).upsert().replace_one(document)
+                else:
+                    bulk.find(document).remove_one()
+            bulk.execute()
+        self.written += len(self.pending)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,135 @@
+"""
+Counters and timers for seeing where a run spends its time.
+
+Every module records into the process-wide `STATS`:
+
+    with instrument.timer('tesseract'):
+        texts = backend.ocr(regions)
+    instrument.STATS['cache_hits'] += 1
+
+ocr_pdf.py's workers `collect()` what they recorded for each school
+and send it back with the school's documents; the parent `update()`s
+its total with it and prints `summary()` as JSON at the end of the run.
+
+Timers nest, so a stage's time includes any stage timed inside it (a
+page_open includes its threshold, for instance).
+"""
+
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the per-school latency histogram.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+class Stats(object):
+    """
+    Counters (used like a Counter), stage timers and per-school
+    latencies. Stats pickle, so workers can hand them back.
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.latencies = []
+
+    def __getitem__(self, key):
+        return self.counters[key]
+
+    def __setitem__(self, key, value):
+        self.counters[key] = value
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.time() - start
+            self.calls[stage] += 1
+
+    def record_school(self, seconds):
+        self.latencies.append(seconds)
+
+    def update(self, other):
+        self.counters.update(other.counters)
+        for (stage, seconds) in other.seconds.iteritems():
+            self.seconds[stage] += seconds
+        self.calls.update(other.calls)
+        self.latencies.extend(other.latencies)
+
+    def histogram(self):
+        """
+        Return [(label, schools), ...] bucketing the per-school
+        latencies by LATENCY_BUCKETS.
+        """
+        counts = Counter()
+        for seconds in self.latencies:
+            for bound in LATENCY_BUCKETS:
+                if seconds <= bound:
+                    counts['<=%ds' % bound] += 1
+                    break
+            else:
+                counts['>%ds' % LATENCY_BUCKETS[-1]] += 1
+        labels = ['<=%ds' % bound for bound in LATENCY_BUCKETS]
+        labels.append('>%ds' % LATENCY_BUCKETS[-1])
+        return [(label, counts[label]) for label in labels if counts[label]]
+
+    def summary(self):
+        """
+        Everything recorded, as a JSON-friendly dict.
+        """
+        latencies = sorted(self.latencies)
+        schools = {'count': len(latencies)}
+        if latencies:
+            schools.update({
+                'mean': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) // 2],
+                'p90': latencies[int(len(latencies) * 0.9)],
+                'max': latencies[-1],
+                'histogram': self.histogram(),
+            })
+        return {
+            'counters': dict(self.counters),
+            'stages': {stage: {'seconds': round(seconds, 3),
+                               'calls': self.calls[stage]}
+                       for (stage, seconds) in self.seconds.iteritems()},
+            'schools': schools,
+        }
+
+STATS = Stats()
+
+def timer(stage):
+    return STATS.timer(stage)
+
+def collect():
+    """
+    Return everything recorded so far in this process and start over.
+    """
+    global STATS
+    (stats, STATS) = (STATS, Stats())
+    return stats
+
+class Progress(object):
+    """
+    A one-line "done/total, rate, ETA" display, redrawn in place.
+    """
+    def __init__(self, total, label='schools', stream=sys.stderr):
+        self.total = total
+        self.label = label
+        self.stream = stream
+        self.done = 0
+        self.start = time.time()
+
+    def update(self, n=1):
+        self.done += n
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / rate if rate else 0
+        self.stream.write('\r%d/%d %s, %.1f/min, ETA %d:%02d:%02d ' % (
+            self.done, self.total, self.label, 60 * rate,
+            eta // 3600, eta % 3600 // 60, eta % 60))
+        if self.done >= self.total:
+            self.stream.write('\n')
+        self.stream.flush()
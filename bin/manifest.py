@@ -0,0 +1,161 @@
+"""
+Remember what ocr_pdf.py last extracted for each school, so a rerun
+only redoes the regions whose coordinates or source page changed.
+
+For every school the manifest records a signature (mtime and size) of
+each TIFF page, a signature of the settings that affect the values
+read (OCR backend, --text-layer, --source and so on) and which config
+sections it was extracted with. For each config section the manifest
+keeps a hash of its coordinate set along with the coordinates of
+every category. Tweaking one box in a config then re-extracts that
+one box per school, touching a school's TIFFs re-extracts only that
+school and changing the settings re-extracts everything.
+
+The manifest is a JSON file in the year/type directory, one per config
+(see `default_path`). Sections are the same for every school extracted
+with the same config, so they're stored once, keyed by `sections_hash`,
+rather than in every school's entry.
+"""
+
+import os
+import json
+import hashlib
+
+def default_path(config_file):
+    """
+    >>> default_path('../../config/hs.2011-12.ini')
+    '.ocr-manifest.hs.2011-12.json'
+    """
+    name = os.path.splitext(os.path.basename(config_file))[0]
+    return '.ocr-manifest.%s.json' % name
+
+def page_signature(fn):
+    # A PDF page ('school.pdf#2') changes whenever its PDF does.
+    fn = fn.split('#', 1)[0]
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return '%d:%d' % (st.st_mtime, st.st_size)
+
+def section_hash(categories):
+    digest = hashlib.sha1()
+    for (category, coordinates) in sorted(categories.iteritems()):
+        digest.update('%s=%s\n' % (category, coordinates))
+    return digest.hexdigest()
+
+def sections_hash(sections):
+    digest = hashlib.sha1()
+    for (section, info) in sorted(sections.iteritems()):
+        digest.update('%s=%s\n' % (section, info['hash']))
+    return digest.hexdigest()
+
+def settings_signature(settings):
+    """
+    >>> settings_signature({'ocr': 'batch', 'text_layer': False})
+    'ocr=batch;text_layer=False'
+    """
+    return ';'.join('%s=%s' % item for item in sorted(settings.iteritems()))
+
+def build_sections(coordinates):
+    """
+    Describe the config sections that will be extracted, given
+    {section: {category: coordinates}} (see RegionPlan.coordinates).
+    This is the same for every school, so build it once per run.
+    """
+    sections = {}
+    for (section, categories) in coordinates.iteritems():
+        sections[section] = {
+            'hash': section_hash(categories),
+            'categories': categories,
+        }
+    return sections
+
+def build_entry(tiff_files, sections, settings=None):
+    """
+    Describe the current state of a school: its pages, the config
+    sections (see build_sections) that will be extracted from them and
+    the extraction `settings`, a dict of option names and values.
+    """
+    return {
+        'pages': {str(n): page_signature(fn) for (n, fn) in tiff_files.iteritems()},
+        'settings': settings_signature(settings or {}),
+        'sections': sections,
+    }
+
+def changed_categories(old, new):
+    """
+    Return the set of (section, category) pairs that need extracting
+    to bring a school from the `old` entry to the `new` one.
+    """
+    if old is None or old.get('settings') != new.get('settings'):
+        return set((section, category)
+                   for (section, info) in new['sections'].iteritems()
+                   for category in info['categories'])
+
+    changed = set()
+    for (section, info) in new['sections'].iteritems():
+        page = section.split('-', 1)[0]
+        previous = old['sections'].get(section)
+        if previous is None or old['pages'].get(page) != new['pages'].get(page):
+            changed.update((section, category) for category in info['categories'])
+        elif previous['hash'] != info['hash']:
+            changed.update((section, category)
+                           for (category, coordinates) in info['categories'].iteritems()
+                           if previous['categories'].get(category) != coordinates)
+    return changed
+
+def removed_categories(old, new):
+    """
+    Return the (section, category) pairs that were extracted last time
+    but are no longer in the config.
+    """
+    if old is None:
+        return set()
+    return set((section, category)
+               for (section, info) in old['sections'].iteritems()
+               for category in info['categories']
+               if category not in new['sections'].get(section, {}).get('categories', {}))
+
+class Manifest(object):
+    """
+    Entries go in and come out with their sections in full; on disk
+    each school refers to its sections by `sections_hash`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sections = {}
+        self.schools = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            self.sections = data.get('sections', {})
+            self.schools = data.get('schools', {})
+
+    def get(self, school):
+        # A school whose sections are missing (or were written by an
+        # older version) is extracted from scratch.
+        entry = self.schools.get(school)
+        key = entry and entry.get('sections')
+        if not isinstance(key, basestring) or key not in self.sections:
+            return None
+        return dict(entry, sections=self.sections[entry['sections']])
+
+    def update(self, school, entry):
+        key = sections_hash(entry['sections'])
+        self.sections[key] = entry['sections']
+        self.schools[school] = dict(entry, sections=key)
+
+    def remove(self, school):
+        self.schools.pop(school, None)
+
+    def save(self):
+        used = set(entry['sections'] for entry in self.schools.itervalues())
+        sections = {key: self.sections[key] for key in used}
+        # Write to a temp file and rename it into place so an
+        # interrupted run never leaves a half-written manifest behind.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'sections': sections, 'schools': self.schools},
+                      fp, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
@@ -0,0 +1,318 @@
+"""
+OCR backends used by ocr_pdf.py.
+
+Every backend has an `ocr(regions)` method that takes a list of
+regions and returns their text, in the same order, after running it
+through `clean_text`. A region is either the path to an image on disk
+or an in-memory PIL Image.
+
+- ShellBackend runs one `tesseract` process per region (the original
+  behaviour).
+- BatchBackend runs a single `tesseract` process over every region, so
+  the language data is only loaded once per batch. In-memory regions
+  are piped in as one multi-page TIFF; regions on disk (or regions
+  this PIL can't write a multi-page TIFF of) go through a list file.
+- TesserocrBackend keeps a long-lived tesseract instance in-process via
+  the tesserocr binding (optional dependency).
+- MontageBackend pastes every region into one tall image and OCRs it
+  in a single pass with layout analysis, then maps the recognised
+  words back to their regions by position. Check it against the
+  other backends with `benchmark.py montage` before relying on it.
+
+The first three run tesseract in single-line mode (-psm 7). All of
+them read its output straight from a pipe, so nothing is shared
+between concurrent ocr_pdf.py runs.
+
+A backend whose results can differ from single-line mode's has a
+`settings` attribute, which goes into the OCR cache key in place of
+OCR_SETTINGS.
+"""
+
+import os
+import re
+import bisect
+import shutil
+import tempfile
+import subprocess
+from cStringIO import StringIO
+
+import instrument
+
+COMMON_TRANSLATIONS = {'O': '0', '_': '-'}
+
+# Anything that changes what tesseract returns for a given image.
+# It's part of every OCR cache key, so bump it when the settings or
+# COMMON_TRANSLATIONS change.
+OCR_SETTINGS = 'psm=7'
+
+# tesseract puts a form feed between pages of multi-image output.
+PAGE_SEPARATOR = '\f'
+
+def encode_image(image):
+    """
+    Return an in-memory PIL Image as uncompressed TIFF bytes.
+    """
+    buf = StringIO()
+    image.save(buf, 'TIFF')
+    return buf.getvalue()
+
+def encode_images(images):
+    """
+    Return a list of in-memory PIL Images as the bytes of one
+    uncompressed multi-page TIFF, or None if this version of PIL can
+    only write single-page TIFFs.
+    """
+    buf = StringIO()
+    images[0].save(buf, 'TIFF', save_all=True, append_images=images[1:])
+    if len(images) > 1:
+        # PIL before Pillow 3.4 ignores save_all and quietly writes
+        # just the first page.
+        import Image
+        buf.seek(0)
+        try:
+            Image.open(buf).seek(len(images) - 1)
+        except EOFError:
+            return None
+    return buf.getvalue()
+
+def run_tesseract(image, psm=7, config=None, data=None):
+    """
+    Run tesseract on `image` and return whatever it writes to stdout.
+
+    `image` is either a path (to an image, or to a file listing
+    images) or a PIL Image, which is piped in over stdin. Already
+    encoded image `data` is piped in as is. `config` is the name of a
+    tesseract config file, such as 'hocr'.
+    """
+    if data is not None:
+        source = 'stdin'
+    elif isinstance(image, basestring):
+        source = image
+    else:
+        (source, data) = ('stdin', encode_image(image))
+
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(['tesseract', source, 'stdout', '-psm', str(psm)]
+                                + ([config] if config else []),
+                                stdin=subprocess.PIPE if data else None,
+                                stdout=subprocess.PIPE, stderr=devnull)
+        (output, _) = proc.communicate(data)
+    return output
+
+def clean_text(content):
+    """
+    Strip whitespace and fix up the usual single-character misreads.
+
+    >>> clean_text(' O\\n')
+    '0'
+    """
+    content = content.strip()
+    return COMMON_TRANSLATIONS.get(content, content)
+
+class ShellBackend(object):
+    """
+    One `tesseract` process per region.
+    """
+    def ocr(self, regions):
+        return [self.ocr_one(region) for region in regions]
+
+    def ocr_one(self, region):
+        return clean_text(run_tesseract(region))
+
+class BatchBackend(object):
+    """
+    A single `tesseract` process for a whole list of regions.
+
+    tesseract reads either a multi-page TIFF (which is how in-memory
+    regions are sent, over stdin) or a text file listing one image per
+    line, and writes the text of every page to stdout, separated by
+    form feeds. If the number of pages we get back doesn't line up
+    with the number of regions we sent, fall back to one process per
+    region rather than risk shifting values between categories.
+    """
+    def __init__(self, fallback=None):
+        self.fallback = fallback or ShellBackend()
+
+    def ocr(self, regions):
+        if not regions:
+            return []
+
+        data = None
+        if not any(isinstance(region, basestring) for region in regions):
+            data = encode_images(regions)
+        if data is not None:
+            output = run_tesseract(None, data=data)
+        else:
+            output = self.ocr_list(regions)
+        pages = output.split(PAGE_SEPARATOR)
+
+        # Trailing separator leaves an empty final element.
+        if len(pages) == len(regions) + 1 and not pages[-1].strip():
+            pages.pop()
+
+        if len(pages) != len(regions):
+            return self.fallback.ocr(regions)
+
+        return [clean_text(page) for page in pages]
+
+    def ocr_list(self, regions):
+        # The list file (and any regions spooled to disk) are private
+        # to this call; the text comes back over stdout.
+        tmp = tempfile.mkdtemp(prefix='ccsd-ocr-')
+        try:
+            paths = []
+            for (n, region) in enumerate(regions):
+                if not isinstance(region, basestring):
+                    path = os.path.join(tmp, '%d.tiff' % n)
+                    region.save(path)
+                    instrument.STATS['spooled_regions'] += 1
+                    region = path
+                paths.append(region)
+
+            list_file = os.path.join(tmp, 'regions.txt')
+            with open(list_file, 'w') as fp:
+                fp.write('\n'.join(paths) + '\n')
+
+            return run_tesseract(list_file)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+class TesserocrBackend(object):
+    """
+    Keep one tesseract instance loaded for the life of the process.
+
+    The API object is created lazily (and again after a fork) so that
+    each ocr_pdf.py worker gets its own instance.
+    """
+    def __init__(self):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.api = None
+        self.pid = None
+
+    def get_api(self):
+        if self.api is None or self.pid != os.getpid():
+            self.api = self.tesserocr.PyTessBaseAPI(
+                psm=self.tesserocr.PSM.SINGLE_LINE)
+            self.pid = os.getpid()
+        return self.api
+
+    def ocr(self, regions):
+        api = self.get_api()
+        ret = []
+        for region in regions:
+            if isinstance(region, basestring):
+                api.SetImageFile(region)
+            else:
+                api.SetImage(region)
+            ret.append(clean_text(api.GetUTF8Text()))
+        return ret
+
+HOCR_WORD = re.compile(r"""<span class=['"]ocrx_word['"][^>]*"""
+                       r"""title=['"]bbox (\d+) (\d+) (\d+) (\d+)[^>]*>(.*?)</span>""",
+                       re.S)
+
+def parse_hocr(hocr):
+    """
+    Return (x0, y0, x1, y1, text) for every word in tesseract's hOCR.
+
+    >>> parse_hocr("<span class='ocrx_word' title='bbox 1 2 30 40; x_wconf 91'>12.9</span>")
+    [(1, 2, 30, 40, '12.9')]
+    """
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+    words = []
+    for match in HOCR_WORD.finditer(hocr):
+        text = unescape(re.sub('<[^>]+>', '', match.group(5)).decode('utf-8'))
+        if text.strip():
+            box = tuple(int(n) for n in match.groups()[:4])
+            words.append(box + (text.strip().encode('utf-8'),))
+    return words
+
+class MontageBackend(object):
+    """
+    OCR many regions with one tesseract pass over a montage of them.
+
+    Regions are stacked one per row, left-aligned, with a blank gap at
+    least as tall as the tallest region between rows so no line of text
+    can run into the next. tesseract lays the montage out as a block
+    (-psm 6) and reports each word's bounding box as hOCR; every word
+    belongs to the row its vertical centre falls in, and a row's words
+    are joined left to right.
+
+    Montages are capped at `max_height` pixels, so a big batch becomes
+    a few passes rather than one enormous image.
+    """
+    settings = 'montage:psm=6'
+
+    def __init__(self, margin=20, max_height=30000):
+        self.margin = margin
+        self.max_height = max_height
+
+    def ocr(self, regions):
+        import Image
+        regions = [Image.open(region) if isinstance(region, basestring) else region
+                   for region in regions]
+
+        ret = []
+        chunk = []
+        (total, tallest) = (0, 0)
+        for region in regions:
+            # Every gap is as tall as the tallest region in the
+            # montage, so a tall region grows the gaps of the whole
+            # chunk, not just its own row.
+            height = region.size[1]
+            gap = max(self.margin, tallest, height)
+            if chunk and (len(chunk) + 2) * gap + total + height > self.max_height:
+                ret.extend(self.ocr_montage(chunk))
+                (chunk, total, tallest) = ([], 0, 0)
+            chunk.append(region)
+            total += height
+            tallest = max(tallest, height)
+        if chunk:
+            ret.extend(self.ocr_montage(chunk))
+        return ret
+
+    def montage(self, regions):
+        """
+        Return the montage Image and the top of each region's row.
+        """
+        import Image
+        gap = max(self.margin, max(region.size[1] for region in regions))
+        width = max(region.size[0] for region in regions) + 2 * self.margin
+        tops = []
+        y = gap
+        for region in regions:
+            tops.append(y)
+            y += region.size[1] + gap
+
+        im = Image.new('L', (width, y), 255)
+        for (region, top) in zip(regions, tops):
+            im.paste(region.convert('L'), (self.margin, top))
+        # A row "starts" halfway into the gap above it, so each word
+        # is matched to the nearest region.
+        return (im, [top - gap // 2 for top in tops])
+
+    def ocr_montage(self, regions):
+        (im, tops) = self.montage(regions)
+        rows = [[] for region in regions]
+        for (x0, y0, x1, y1, text) in parse_hocr(run_tesseract(im, psm=6, config='hocr')):
+            n = bisect.bisect_right(tops, (y0 + y1) // 2) - 1
+            if n >= 0:
+                rows[n].append((x0, text))
+        return [clean_text(' '.join(text for (_, text) in sorted(words)))
+                for words in rows]
+
+BACKENDS = {
+    'shell': ShellBackend,
+    'batch': BatchBackend,
+    'tesserocr': TesserocrBackend,
+    'montage': MontageBackend,
+}
+
+def get_backend(name):
+    """
+    Return an instance of the named OCR backend.
+    """
+    return BACKENDS[name]()
@@ -0,0 +1,106 @@
+"""
+Caches for OCR results, keyed by ocr_pdf.region_key().
+
+Every cache has `get_many(keys)`, returning a {key: text} dict of the
+keys it knows about, and `set_many(mapping)`. ocr_pdf.py looks up all
+of a school's regions with one get_many() and stores everything it had
+to OCR with one set_many().
+
+Caches are picked with a spec string (see `open_cache`):
+
+- redis                 Redis on localhost
+- redis://host:port/db  Redis somewhere else
+- sqlite:PATH           a local SQLite file; no server required
+- memory                a plain dict that lasts as long as the process
+"""
+
+import os
+import sqlite3
+
+class RedisCache(object):
+    def __init__(self, url=None):
+        import redis
+        if url:
+            self.conn = redis.StrictRedis.from_url(url)
+        else:
+            self.conn = redis.StrictRedis()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        return {key: value for (key, value) in zip(keys, self.conn.mget(keys))
+                if value is not None}
+
+    def set_many(self, mapping):
+        if mapping:
+            self.conn.mset(mapping)
+
+class SQLiteCache(object):
+    """
+    A single-table SQLite database.
+
+    The connection is opened lazily (and again after a fork) so each
+    ocr_pdf.py worker gets its own; WAL mode lets them read while
+    another one writes.
+    """
+    # Stay under SQLite's default limit of 999 bound parameters.
+    CHUNK_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.pid = None
+
+    def get_conn(self):
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.conn.text_factory = str
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS ocr '
+                              '(key TEXT PRIMARY KEY, value TEXT)')
+            self.pid = os.getpid()
+        return self.conn
+
+    def get_many(self, keys):
+        conn = self.get_conn()
+        ret = {}
+        for n in xrange(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[n:n + self.CHUNK_SIZE]
+            query = 'SELECT key, value FROM ocr WHERE key IN (%s)' % (
+                ','.join('?' * len(chunk)))
+            ret.update(conn.execute(query, chunk))
+        return ret
+
+    def set_many(self, mapping):
+        if mapping:
+            conn = self.get_conn()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO ocr (key, value) '
+                                 'VALUES (?, ?)', mapping.iteritems())
+
+class MemoryCache(object):
+    def __init__(self):
+        self.data = {}
+
+    def get_many(self, keys):
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set_many(self, mapping):
+        self.data.update(mapping)
+
+def open_cache(spec):
+    """
+    Return the cache described by `spec`.
+
+    >>> open_cache('sqlite:/var/ccsd-scripts/ocr.sqlite')
+    <ocr_cache.SQLiteCache object at 0x...>
+    """
+    if spec == 'redis':
+        return RedisCache()
+    elif spec.startswith('redis://'):
+        return RedisCache(spec)
+    elif spec.startswith('sqlite:'):
+        return SQLiteCache(spec[len('sqlite:'):])
+    elif spec == 'memory':
+        return MemoryCache()
+    raise ValueError("unknown cache %r" % spec)
@@ -1,103 +1,175 @@
 #!/usr/bin/env python
 
-import re
 import os
-import redis
+import json
+import time
 import pprint
 import tablib
 import hashlib
-import pymongo
 import operator
-import Image, ImageOps
-from collections import defaultdict
+import multiprocessing
+from itertools import imap
+from collections import defaultdict, OrderedDict
 from operator import itemgetter
-from configparser import ConfigParser, ExtendedInterpolation
-
-ccsd_database = pymongo.Connection().ccsd
-
-IMAGE_CACHE = {'active': None, 'im': None}
-COMMON_TRANSLATIONS = {'O': '0', '_': '-'}
-
-redis_conn = redis.StrictRedis()
-
-def coords(coord):
-    """
-    Translate (x, y) coordinates along with (width, height)
-    measurements into a box used to crop the TIFF image.
-
-    >>> coords('615,158 32,24')
-    (615, 158, 615+32, 158+24)
-    """
-    x, y, w, h = re.search('^(\d+),(\d+)[ ,](\d+),(\d+)$', coord).groups()
-    x, y, w, h = map(int, [x, y, w, h])
-    return (x, y, x+w, y+h)
-
-def extract_region(image, coordinates):
-    """
-    Crop the given image using the given coordinates into output file.
-    """
-    output = hashlib.md5(image + coordinates).hexdigest()
-    root = '/var/ccsd-scripts/regions/%s/%s/' % (output[:2], output[2:4])
-    if not os.path.isdir(root):
-        os.makedirs(root)
-    output = os.path.join(root, output + '.tiff')
-    if not os.path.exists(output):
-        print("extracting_region(%r, %r)" % (image, coordinates))
-        # Cache the Image object to speed things up.
-        #
-        # This way, we only open an original image up once and crop as
-        # many times as needed -- rather than opening the same
-        # original image a bunch of times.
-        #
-        # We only store the active Image object and discard it once we
-        # move onto the next image to keep the cache from growing too
-        # big. Since we only open image files once, this isn't a huge
-        # deal.
-        if not IMAGE_CACHE['active'] == image:
-            IMAGE_CACHE['active'] = image
-            IMAGE_CACHE['im'] = Image.open(image)
-        im = IMAGE_CACHE['im']
-        box = coords(coordinates)
-        region = im.crop(box)
-        pix = region.load()
-        # If the top-leftmost pixel isn't white, coerce to black and white.
-        if pix[0,0] != (255, 255, 255):
-            region = ImageOps.grayscale(region)
-            # http://stackoverflow.com/questions/6485254/how-to-i-use-pil-image-pointtable-method-to-apply-a-threshold-to-a-256-gray-im
-            region = region.point(lambda p: p > 50 and 255)
-        region.save(output)
-    return output
-
-def extract_text(region):
+from ocr_backend import BACKENDS, OCR_SETTINGS, get_backend
+from ocr_cache import open_cache
+from ingest import BulkWriter, get_collection
+import instrument
+import manifest
+from page_cache import PageCache
+import preprocess
+import rasterise
+from region_plan import coords, format_coords, load_plan, PLAN_DIR
+
+# Page number -> the rectangle to render when reading PDFs with --clip.
+PAGE_CLIPS = {}
+
+# Decoded pages, shared by every crop in this process.
+PAGE_CACHE = PageCache(loader=lambda fn: preprocess.load_page(fn, PAGE_CLIPS),
+                       sizer=preprocess.page_bytes)
+
+# Stands in for the cache key of a blank region.
+BLANK = None
+
+# Where regions are written when ocr_pdf.py is run with --region-store.
+REGION_STORE = '/var/ccsd-scripts/regions'
+
+# Filled in by main() before the worker pool is forked so every worker
+# inherits the compiled region plan and OCR backend rather than
+# re-creating them. Keyed by config file, since ccsd-pipeline.py runs
+# several configs through one pool; each value is the keyword arguments
+# for process_school.
+WORKER_OPTIONS = {}
+
+def region_path(image, coordinates, store=REGION_STORE):
     """
-    Return a given region's text via OCR.
+    Return where a region is saved inside the region store.
     """
-    if not redis_conn.exists(region):
-        print("extract_text(%r)" % region)
-        cmd = "tesseract {} {} -psm 7 &>/dev/null"
-        os.system(cmd.format(region, "/tmp/output"))
+    output = hashlib.md5(image + format_coords(coordinates)).hexdigest()
+    return os.path.join(store, output[:2], output[2:4], output + '.tiff')
 
-        with open("/tmp/output.txt") as fp:
-            content = fp.read().strip()
-            content = COMMON_TRANSLATIONS.get(content, content)
+def region_key(region, settings=OCR_SETTINGS):
+    """
+    Return the cache key for a cropped region.
 
-        redis_conn.set(region, content)
-        return content
-    else:
-        return redis_conn.get(region)
+    The key is a hash of the region's pixels (plus the OCR settings),
+    not of where it came from, so identical glyphs -- every "0", "Yes"
+    or blank cell -- are only OCR'd once no matter which school, year
+    or rendering of the PDF they turn up in.
+    """
+    data = region.tobytes() if hasattr(region, 'tobytes') else region.tostring()
+    digest = hashlib.sha1()
+    digest.update('%s|%s|%dx%d|' % (settings, region.mode,
+                                    region.size[0], region.size[1]))
+    digest.update(data)
+    return 'ocr:' + digest.hexdigest()
+
+def crop_region(image, coordinates):
+    """
+    Crop the given image using the given coordinates and return the
+    (thresholded) region as an Image.
+    """
+    # The page is thresholded as a whole when it's decoded; see
+    # preprocess.Page for when a crop is left alone.
+    page = PAGE_CACHE.get(image)
+    with instrument.timer('crop'):
+        return page.crop(coords(coordinates))
+
+def extract_region(image, coordinates, store=None):
+    """
+    Crop the given image using the given coordinates and return the
+    region as an Image.
+
+    When `store` is given the region is also saved under it (handy for
+    eyeballing crops with find-region.py).
+    """
+    region = crop_region(image, coordinates)
+    if store is not None:
+        output = region_path(image, coordinates, store)
+        if not os.path.exists(output):
+            root = os.path.dirname(output)
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            with instrument.timer('save'):
+                region.save(output)
+    return region
+
+def is_blank(image, coordinates, min_ink):
+    """
+    Whether the region has too little ink to be worth OCR'ing.
+    """
+    if not min_ink:
+        return False
+    page = PAGE_CACHE.get(image)
+    with instrument.timer('blank_check'):
+        ink = page.ink(coords(coordinates))
+    return ink is not None and ink < min_ink
 
-def build_config(config_file):
+def extract_text(image, coordinates, backend, cache, store=None,
+                 min_ink=preprocess.BLANK_MIN_INK):
+    """
+    Return a given region's text via OCR.
     """
-    Build a ConfigParser object.
+    return extract_texts([(image, coordinates)], backend, cache, store,
+                         min_ink=min_ink)[0]
 
-    Two notes:
-    - Use ExtendedInterpolation
-    - Don't downcase key names
+def extract_texts(boxes, backend, cache, store=None, stats=None,
+                  min_ink=preprocess.BLANK_MIN_INK):
     """
-    config = ConfigParser(interpolation=ExtendedInterpolation())
-    config.optionxform = lambda opt: opt
-    config.read([config_file])
-    return config
+    Return the text of each (image, coordinates) box via OCR, where
+    coordinates are either as written in the config or an already
+    parsed (x0, y0, x1, y1) box.
+
+    Every box is cropped and all of them are looked up in the cache
+    (by pixels) at once; the ones we haven't seen before are handed to
+    the OCR backend in a single batch and written back in one go.
+    Cache hits and misses are tallied in `stats` (by default,
+    instrument.STATS), along with how long each step took.
+
+    Boxes are cropped grouped by page, so a page is done with before
+    the next one is decoded, whatever order the config lists them in.
+    Boxes with fewer than `min_ink` black pixels are blank and come
+    back as '' without being cropped or OCR'd at all.
+    """
+    if stats is None:
+        stats = instrument.STATS
+
+    regions = [None] * len(boxes)
+    for n in sorted(xrange(len(boxes)), key=lambda n: boxes[n][0]):
+        (image, coordinates) = boxes[n]
+        if is_blank(image, coordinates, min_ink):
+            stats['blank_regions'] += 1
+        else:
+            regions[n] = extract_region(image, coordinates, store)
+    # Backends that don't OCR one line at a time keep their own
+    # results in the cache.
+    settings = getattr(backend, 'settings', OCR_SETTINGS)
+    with stats.timer('region_key'):
+        keys = [BLANK if region is None else region_key(region, settings)
+                for region in regions]
+
+    with stats.timer('cache_get'):
+        results = cache.get_many(list(set(keys) - set([BLANK])))
+    results[BLANK] = ''
+    missing = OrderedDict()
+    for (key, region) in zip(keys, regions):
+        if key == BLANK:
+            continue
+        elif key in results or key in missing:
+            stats['cache_hits'] += 1
+        else:
+            stats['cache_misses'] += 1
+            missing[key] = region
+
+    if missing:
+        print("extract_texts(%d regions)" % len(missing))
+        with stats.timer('tesseract'):
+            texts = dict(zip(missing, backend.ocr(missing.values())))
+        with stats.timer('cache_set'):
+            cache.set_many(texts)
+        results.update(texts)
+
+    return [results[key] for key in keys]
 
 def get_tiff_files(tiff_dir):
     """
@@ -112,6 +184,23 @@ def get_tiff_files(tiff_dir):
         tiff_files = {n: os.path.join(full_tiff_dir, 'page_%02d.tiff' % n) for n in xrange(1, 5)}
         yield (school, tiff_files)
 
+def page_clips(plan, clips=None):
+    """
+    Return {page: (x0, y0, x1, y1)}, the smallest rectangle on each
+    page that covers every box in a RegionPlan.
+
+    Passing `clips` grows those rectangles to cover `plan` as well.
+    """
+    if clips is None:
+        clips = {}
+    for (page, box) in plan.boxes():
+        if page in clips:
+            clip = clips[page]
+            box = (min(clip[0], box[0]), min(clip[1], box[1]),
+                   max(clip[2], box[2]), max(clip[3], box[3]))
+        clips[page] = box
+    return clips
+
 def get_school_type(tiff_files):
     fn = tiff_files[1]
     if '/es/' in fn:
@@ -121,67 +210,383 @@ def get_school_type(tiff_files):
     elif '/hs/' in fn:
         return 'High'
 
-def insert_documents(documents):
-    ccsd_database.ccsd.insert(documents, safe=True)
-
 def get_current_year():
     if '2010-11' in os.getcwd():
         return '2010-11'
     elif '2011-12' in os.getcwd():
         return '2011-12'
 
-def remove_existing_documents(config):
-    school_type = None
-    year = get_current_year()
+def remove_existing_documents(config, year=None, school_type=None):
+    """
+    Remove a type/year's documents. Unless it's given, the type comes
+    from the config's filename (e.g. hs.2011-12.ini); the rest of the
+    path could say anything.
+    """
+    if year is None:
+        year = get_current_year()
 
-    if 'hs' in config:
-        school_type = 'High'
-    elif 'ms' in config:
-        school_type = 'Middle'
-    elif 'es' in config:
-        school_type = 'Elementary'
+    if school_type is None:
+        school_type = {
+            'hs': 'High',
+            'ms': 'Middle',
+            'es': 'Elementary',
+        }.get(os.path.basename(config).split('.', 1)[0])
 
     if school_type is not None and year is not None:
-        ccsd_database.ccsd.remove({'school.type': school_type,
-                                   'year': year})
+        get_collection().remove({'school.type': school_type,
+                                 'year': year})
+
+def find_pdf(school, tiff_files):
+    """
+    Return the PDF a school's pages came from, or None if it's gone.
+    """
+    pdf_page = rasterise.parse_page_name(tiff_files[1])
+    if pdf_page is not None:
+        return pdf_page[0]
+    # pdf-to-tiff.sh renders pdf/<school>.pdf into tiff/<school>/.
+    tiff_dir = os.path.dirname(os.path.dirname(tiff_files[1]))
+    pdf = os.path.normpath(os.path.join(tiff_dir, '..', 'pdf', school + '.pdf'))
+    return pdf if os.path.exists(pdf) else None
+
+def read_text_layer(school, tiff_files, boxes):
+    """
+    Return {(page, box): text} for every (page, box) in `boxes` whose
+    text can be read straight from the school's PDF.
+    """
+    from text_layer import TextLayer
+
+    pdf = find_pdf(school, tiff_files)
+    if pdf is None:
+        return {}
+
+    layer = TextLayer(pdf)
+    values = {}
+    try:
+        for (page, box) in boxes:
+            text = layer.text_in_box(page, box)
+            if text is not None:
+                values[(page, box)] = text
+    except Exception as e:
+        # A PDF pdfminer can't make sense of just means OCR'ing it all.
+        print("Couldn't read the text layer of %r: %s" % (pdf, e))
+        return {}
+    return values
+
+def process_school(school, tiff_files, plan, backend, cache, store=None,
+                   stats=None, only=None, min_ink=preprocess.BLANK_MIN_INK,
+                   text_layer=False, year=None):
+    """
+    OCR every region in a RegionPlan for a single school and return
+    the list of documents to insert.
+
+    When `only` is given, just the (section, category) pairs in it are
+    extracted. With `text_layer`, boxes are read from the PDF's text
+    layer first and only the ones that come up empty are OCR'd.
+    `year` defaults to the one in the current directory's path.
+    """
+    if stats is None:
+        stats = instrument.STATS
+
+    print("Processing '{}'".format(school))
+    (school_id, school_name) = school.split('-', 1)
+
+    entries = [entry for entry in plan.entries
+               if only is None or (entry[0], entry[1]) in only]
+
+    # Categories that share a box (often via ${...} references in the
+    # config) are one entry in the plan, so they're cropped and OCR'd
+    # once and the text fanned out.
+    boxes = list(plan.boxes(only))
+    stats['duplicate_boxes'] += sum(1 for entry in entries
+                                    if entry[3] is not None) - len(boxes)
+
+    texts = {}
+    if text_layer:
+        with stats.timer('text_layer'):
+            texts = read_text_layer(school, tiff_files, boxes)
+    stats['text_layer_hits'] += len(texts)
+
+    boxes = [(page, box) for (page, box) in boxes if (page, box) not in texts]
+    texts.update(zip(boxes, extract_texts([(tiff_files[page], box)
+                                           for (page, box) in boxes],
+                                          backend, cache, store, stats, min_ink)))
+
+    school_info = {
+        'name': school_name,
+        'id': int(school_id),
+        'type': get_school_type(tiff_files),
+    }
+    if year is None:
+        year = get_current_year()
+
+    documents = []
+    for (section, category, page, box) in entries:
+        documents.append({
+            'school': school_info,
+            'year': year,
+            'section': section,
+            'category': category,
+            # A box-less category produces an empty column.
+            'value': '' if box is None else texts[(page, box)],
+        })
+
+    return documents
+
+def report_boxes(config_file, plan):
+    (boxes, unique) = plan.count_boxes()
+    print("%s: %d boxes, %d distinct; sharing saves %d OCR calls per school" % (
+        os.path.basename(config_file), boxes, unique, boxes - unique))
+
+def _process_school_worker(item):
+    (job, school, tiff_files, only) = item
+    before = PAGE_CACHE.stats()
+    start = time.time()
+    documents = process_school(school, tiff_files, only=only,
+                               **WORKER_OPTIONS[job])
+    after = PAGE_CACHE.stats()
+    # Everything recorded in this process since the last school,
+    # including any bulk writes the serial path made in between.
+    stats = instrument.collect()
+    stats.record_school(time.time() - start)
+    stats['page_decodes'] += after['page_decodes'] - before['page_decodes']
+    stats['page_cache_hits'] += after['page_cache_hits'] - before['page_cache_hits']
+    return (documents, stats, after['page_cache_peak_bytes'])
+
+def write_summary(stats, page_cache_peak_bytes=0, path=None):
+    """
+    Write the run's instrument summary as JSON to `path`, or print it.
+    """
+    summary = stats.summary()
+    summary['page_cache_peak_bytes'] = page_cache_peak_bytes
+    if path is None:
+        print(json.dumps(summary, indent=1, sort_keys=True))
+    else:
+        with open(path, 'w') as fp:
+            json.dump(summary, fp, indent=1, sort_keys=True)
+
+def report_stats(stats, page_cache_peak_bytes=0):
+    lookups = stats['cache_hits'] + stats['cache_misses']
+    if lookups:
+        print("OCR cache: %d hits, %d misses (%.1f%% hit rate)" % (
+            stats['cache_hits'], stats['cache_misses'],
+            100.0 * stats['cache_hits'] / lookups))
+    if stats['text_layer_hits']:
+        print("Read %d regions from the PDF text layer" % stats['text_layer_hits'])
+    if stats['duplicate_boxes']:
+        print("Shared %d duplicate boxes between categories" % stats['duplicate_boxes'])
+    if stats['blank_regions']:
+        print("Skipped %d blank regions" % stats['blank_regions'])
+    if stats['page_decodes']:
+        print("Pages: %d decoded, %d cache hits, peak %.1f MiB per process" % (
+            stats['page_decodes'], stats['page_cache_hits'],
+            page_cache_peak_bytes / (1024.0 * 1024.0)))
+
+def get_sources(source, directory='.'):
+    """
+    Yield (school, pages) for every school under a year/type directory,
+    reading pages from tiff/ or rendering them from pdf/.
+    """
+    if source == 'pdf':
+        return rasterise.get_pdf_files(os.path.join(directory, 'pdf'))
+    return get_tiff_files(os.path.join(directory, 'tiff'))
+
+def extraction_settings(args):
+    """
+    The options that change what's read from a school, for the
+    manifest: rerunning with any of them changed re-extracts
+    everything.
+    """
+    return {
+        'ocr': args.ocr,
+        'source': args.source,
+        'clip': args.source == 'pdf' and args.clip,
+        'text_layer': args.text_layer,
+        'blank_min_ink': args.blank_min_ink,
+    }
+
+def plan_schools(plan, sources, state, year, school_ids=None, force=False,
+                 settings=None):
+    """
+    Work out what changed for each school since the last run.
+
+    Returns (work, removed, entries): the (school, pages, only) items
+    that need extracting, the keys of documents whose category (or
+    school) has gone and the new manifest entry for every school. With
+    `force` every school starts from scratch. `settings` are recorded
+    in each entry (see extraction_settings).
+
+    Unless only some `school_ids` are asked for, schools in the
+    manifest that are no longer among `sources` are dropped from
+    `state` and all of their documents are queued for removal.
+    """
+    work = []
+    removed = []
+    entries = {}
+    sections = manifest.build_sections(plan.coordinates)
+
+    def remove(school, previous, entry):
+        school_id = int(school.split('-', 1)[0])
+        for (section, category) in manifest.removed_categories(previous, entry):
+            removed.append({'school.id': school_id, 'year': year,
+                            'section': section, 'category': category})
+
+    for (school, tiff_files) in sources:
+        if school_ids and school.split('-', 1)[0] not in school_ids:
+            continue
+        entry = manifest.build_entry(tiff_files, sections, settings)
+        previous = None if force else state.get(school)
+        only = manifest.changed_categories(previous, entry)
+        remove(school, previous, entry)
+        entries[school] = entry
+        if only:
+            work.append((school, tiff_files, only))
+
+    if not school_ids:
+        for school in sorted(set(state.schools) - set(entries)):
+            remove(school, state.get(school), {'sections': {}})
+            state.remove(school)
+    return (work, removed, entries)
+
+def write_documents(results, removed, batch_size, progress=None):
+    """
+    Upsert the documents coming back from _process_school_worker and
+    remove the `removed` keys, updating `progress` (an
+    instrument.Progress) after each school. Returns the combined
+    (stats, peak page cache bytes).
+    """
+    stats = instrument.Stats()
+    page_cache_peak_bytes = 0
+    with BulkWriter(get_collection(), batch_size) as writer:
+        for key in removed:
+            writer.remove(key)
+        for (documents, school_stats, peak_bytes) in results:
+            writer.extend(documents)
+            stats.update(school_stats)
+            page_cache_peak_bytes = max(page_cache_peak_bytes, peak_bytes)
+            if progress is not None:
+                progress.update()
+    stats.update(instrument.collect())
+    return (stats, page_cache_peak_bytes)
+
+def worker_options(args, plan, year, backend=None, cache=None):
+    """
+    The process_school keyword arguments for a RegionPlan, reusing
+    `backend` and `cache` when they're given.
+    """
+    return dict(plan=plan, backend=backend or get_backend(args.ocr),
+                cache=cache or open_cache(args.cache), store=args.region_store,
+                min_ink=args.blank_min_ink, text_layer=args.text_layer,
+                year=year)
 
 def main(args):
-    config = build_config(args.config)
-    remove_existing_documents(args.config)
-
-    for school, tiff_files in get_tiff_files('tiff'):
-        print("Processing '{}'".format(school))
-        (school_id, school_name) = school.split('-', 1)
-
-        documents = []
-        document = {
-            'school': {
-                'name': school_name,
-                'id': int(school_id),
-                'type': get_school_type(tiff_files),
-            },
-            'year': get_current_year(),
-        }
-
-        for section in config.sections():
-            (page, section_label) = section.split('-', 1)
-            current_image = tiff_files[int(page)]
-
-            for (category, coordinates) in config[section].items():
-                if coordinates == '': # produce an empty column
-                    text = ''
-                else:
-                    text = extract_text(extract_region(current_image, coordinates))
-                document['section'] = section
-                document['category'] = category
-                document['value'] = text
-                documents.append(document.copy())
-
-        insert_documents(documents)
+    plan = load_plan(args.config, args.plan_dir)
+    year = args.year or get_current_year()
+    if args.clean:
+        remove_existing_documents(args.config, year)
+
+    state = manifest.Manifest(args.manifest or os.path.join(
+        args.directory, manifest.default_path(args.config)))
+    if args.source == 'pdf' and args.clip:
+        page_clips(plan, PAGE_CLIPS)
+    (schools, removed, entries) = plan_schools(
+        plan, get_sources(args.source, args.directory), state, year,
+        args.school, args.force or args.clean, extraction_settings(args))
+
+    print("%d of %d schools need extracting" % (len(schools), len(entries)))
+    report_boxes(args.config, plan)
+    PAGE_CACHE.max_bytes = args.page_cache_mb * 1024 * 1024
+
+    WORKER_OPTIONS[args.config] = worker_options(args, plan, year)
+    items = [(args.config,) + item for item in schools]
+    if args.jobs > 1:
+        # Schools are independent, so hand them out to a pool of
+        # workers. imap() yields results in submission order, which
+        # keeps the inserts identical to the serial path.
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(_process_school_worker, items)
+    else:
+        pool = None
+        results = imap(_process_school_worker, items)
+
+    # Connect only after the pool has forked; workers never write.
+    progress = instrument.Progress(len(items)) if args.progress else None
+    (stats, page_cache_peak_bytes) = write_documents(results, removed,
+                                                     args.batch_size, progress)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for (school, entry) in entries.iteritems():
+        state.update(school, entry)
+    state.save()
+
+    report_stats(stats, page_cache_peak_bytes)
+    write_summary(stats, page_cache_peak_bytes, args.stats)
+
+def add_arguments(parser):
+    """
+    Add the options ocr_pdf.py shares with ccsd-pipeline.py.
+    """
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of schools to OCR in parallel')
+    parser.add_argument('--ocr', choices=sorted(BACKENDS), default='batch',
+                        help='OCR backend (default: %(default)s); check '
+                             "montage against it with 'benchmark.py montage' "
+                             'first')
+    parser.add_argument('--source', choices=['tiff', 'pdf'], default='tiff',
+                        help="read pages from tiff/ (made by 'make tiff') or "
+                             "render them from pdf/ in memory")
+    parser.add_argument('--clip', action='store_true',
+                        help='with --source pdf, only render the part of each '
+                             'page the config covers (uses pdftoppm)')
+    parser.add_argument('--text-layer', action='store_true',
+                        help="read boxes from the PDF's text layer where it "
+                             "has one and only OCR the rest (needs pdfminer)")
+    parser.add_argument('-s', '--school', action='append', metavar='ID',
+                        help='only process the school with this ID '
+                             '(may be repeated)')
+    parser.add_argument('--clean', action='store_true',
+                        help="remove this type/year's documents first")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='ignore the manifest and extract every region')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents per bulk write (default: %(default)s)')
+    parser.add_argument('--cache', default='redis',
+                        help='OCR cache: redis, redis://host:port/db, '
+                             'sqlite:PATH or memory (default: %(default)s)')
+    parser.add_argument('--page-cache-mb', type=int,
+                        default=PAGE_CACHE.max_bytes // (1024 * 1024),
+                        help='memory for decoded pages, per process '
+                             '(default: %(default)s)')
+    parser.add_argument('--blank-min-ink', type=int,
+                        default=preprocess.BLANK_MIN_INK, metavar='PIXELS',
+                        help='treat regions with fewer black pixels as blank '
+                             '(0 to OCR everything; default: %(default)s)')
+    parser.add_argument('--region-store', metavar='DIR',
+                        help='also save every cropped region under DIR '
+                             '(e.g. %s)' % REGION_STORE)
+    parser.add_argument('--plan-dir', default=PLAN_DIR, metavar='DIR',
+                        help='where compiled configs are cached '
+                             '(default: %(default)s)')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a progress line with an ETA on stderr')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write the JSON timing summary to FILE instead '
+                             'of printing it')
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config')
+    parser.add_argument('-y', '--year',
+                        help='e.g. 2011-12 (default: taken from the current directory)')
+    parser.add_argument('-d', '--directory', default='.',
+                        help='the year/type directory holding tiff/ and pdf/ '
+                             '(default: the current directory)')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='where to record what was extracted '
+                             '(default: .ocr-manifest.<config>.json)')
+    add_arguments(parser)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,79 @@
+"""
+A bounded cache of decoded page images.
+
+Decoding a 720 dpi LZW TIFF is one of the slowest steps of a run, so
+ocr_pdf.py keeps recently used pages around, evicting the least
+recently used ones once their decoded size goes over a byte budget.
+Combined with cropping regions page by page, each page of each school
+only has to be decoded once.
+"""
+
+import Image
+from collections import OrderedDict
+
+import instrument
+
+# Enough for all four pages of a high school report at 720 dpi.
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def image_bytes(im):
+    """
+    Roughly how much memory a decoded image takes up.
+    """
+    (width, height) = im.size
+    return width * height * len(im.getbands())
+
+def load_image(fn):
+    im = Image.open(fn)
+    im.load()
+    return im
+
+class PageCache(object):
+    """
+    `loader` turns a key into a fully decoded page and `sizer` says
+    how many bytes that page holds on to.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, loader=load_image,
+                 sizer=image_bytes):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.sizer = sizer
+        self.pages = OrderedDict()
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.decodes = 0
+        self.hits = 0
+
+    def get(self, key):
+        """
+        Return the decoded page for `key` (by default, a filename).
+        """
+        if key in self.pages:
+            self.hits += 1
+            (im, size) = self.pages.pop(key)
+            self.pages[key] = (im, size)
+            return im
+
+        with instrument.timer('page_open'):
+            im = self.loader(key)
+        size = self.sizer(im)
+        self.decodes += 1
+
+        # Make room, but always keep the page we just decoded even if
+        # it's bigger than the whole budget.
+        while self.pages and self.bytes + size > self.max_bytes:
+            (_, (_, evicted)) = self.pages.popitem(last=False)
+            self.bytes -= evicted
+
+        self.pages[key] = (im, size)
+        self.bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        return im
+
+    def stats(self):
+        return {
+            'page_decodes': self.decodes,
+            'page_cache_hits': self.hits,
+            'page_cache_bytes': self.bytes,
+            'page_cache_peak_bytes': self.peak_bytes,
+        }
@@ -0,0 +1,148 @@
+"""
+Turn decoded pages into the black and white regions we OCR.
+
+A Page thresholds the whole page in one go with NumPy (when it's
+installed) instead of running a Python lambda over every pixel of
+every crop, and can count the ink inside a box without cropping it.
+Cells with next to no ink -- blank or N/A boxes -- never need to go
+anywhere near tesseract.
+
+Without NumPy each crop is thresholded with PIL as before.
+"""
+
+import Image, ImageOps
+import instrument
+import rasterise
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Grayscale values above this become white, the rest black.
+THRESHOLD = 50
+
+# A region with fewer black pixels than this is treated as blank. At
+# 720 dpi even a lone period is well over this, while it's enough to
+# ignore the odd speck of scanner noise.
+BLANK_MIN_INK = 50
+
+def threshold(region):
+    """
+    Coerce a region to black and white.
+    """
+    with instrument.timer('threshold'):
+        region = ImageOps.grayscale(region)
+        # http://stackoverflow.com/questions/6485254/how-to-i-use-pil-image-pointtable-method-to-apply-a-threshold-to-a-256-gray-im
+        return region.point(lambda p: p > THRESHOLD and 255)
+
+class Page(object):
+    """
+    A decoded page, or part of one.
+
+    When only part of a page was rendered, `origin` is where its
+    top-left corner sits on the full page; boxes are always given in
+    full-page coordinates.
+    """
+    def __init__(self, image, origin=(0, 0)):
+        self.origin = origin
+        self.image = image
+        self.binary = None
+        if numpy is not None:
+            with instrument.timer('threshold'):
+                gray = image if image.mode == 'L' else ImageOps.grayscale(image)
+                self.binary = (numpy.asarray(gray) > THRESHOLD).astype(numpy.uint8) * 255
+            if image.mode == 'L':
+                # Every crop of a grayscale page gets thresholded, so
+                # there's no need to hang on to the original.
+                self.image = None
+        self.size = image.size
+        self.mode = image.mode
+
+    @property
+    def nbytes(self):
+        size = 0
+        if self.image is not None:
+            size += self.size[0] * self.size[1] * len(self.image.getbands())
+        if self.binary is not None:
+            size += self.binary.nbytes
+        return size
+
+    def translate(self, box):
+        (x, y) = self.origin
+        return (box[0] - x, box[1] - y, box[2] - x, box[3] - y)
+
+    def in_bounds(self, box):
+        (x0, y0, x1, y1) = box
+        return 0 <= x0 <= x1 <= self.size[0] and 0 <= y0 <= y1 <= self.size[1]
+
+    def is_thresholded(self, box):
+        """
+        Whether the crop at `box` gets coerced to black and white:
+        always, unless it's a colour page whose top-leftmost pixel is
+        white.
+        """
+        if self.mode == 'L':
+            return True
+        return self.image.getpixel(box[:2]) != (255, 255, 255)
+
+    def crop(self, box):
+        """
+        Return the region at `box` as an Image.
+        """
+        box = self.translate(box)
+        if not self.is_thresholded(box):
+            return self.image.crop(box)
+        if self.binary is not None and self.in_bounds(box):
+            (x0, y0, x1, y1) = box
+            return Image.fromarray(self.binary[y0:y1, x0:x1])
+        return threshold(self.crop_original(box))
+
+    def crop_original(self, box):
+        if self.image is not None:
+            return self.image.crop(box)
+        # Only the thresholded page was kept; anything outside it is
+        # black, just as PIL pads an out-of-bounds crop.
+        return Image.fromarray(self.binary).crop(box)
+
+    def ink(self, box):
+        """
+        Return how many black pixels the region at `box` has, or None
+        when the region isn't thresholded.
+        """
+        box = self.translate(box)
+        if not self.is_thresholded(box):
+            return None
+        if self.binary is not None and self.in_bounds(box):
+            (x0, y0, x1, y1) = box
+            cell = self.binary[y0:y1, x0:x1]
+            return cell.size - numpy.count_nonzero(cell)
+        if self.binary is not None:
+            return Image.fromarray(self.binary).crop(box).histogram()[0]
+        return threshold(self.image.crop(box)).histogram()[0]
+
+def load_page(fn, clips=None):
+    """
+    Decode the page named `fn`: a TIFF, or a PDF page (see rasterise).
+
+    `clips` maps page numbers to the (x0, y0, x1, y1) rectangle that
+    needs rendering from PDFs; pages without one are rendered whole.
+    """
+    pdf_page = rasterise.parse_page_name(fn)
+    if pdf_page is None:
+        im = Image.open(fn)
+        origin = (0, 0)
+    else:
+        (pdf, n) = pdf_page
+        clip = (clips or {}).get(n)
+        if clip is None:
+            im = rasterise.render_page(pdf, n)
+            origin = (0, 0)
+        else:
+            im = rasterise.render_clip(pdf, n, clip)
+            origin = clip[:2]
+    im.load()
+    return Page(im, origin)
+
+def page_bytes(page):
+    return page.nbytes
@@ -0,0 +1,85 @@
+"""
+Render PDF pages straight to memory, skipping the TIFFs.
+
+`make tiff` has ghostscript write every page of every PDF to a 720 dpi
+LZW TIFF before any OCR happens, even though we only ever look at a
+few hundred small boxes per report. These functions render just the
+pages (or just the part of a page) we need, into an Image:
+
+- render_page() runs the same ghostscript device and resolution as
+  pdf-to-tiff.sh, only to a pipe, so the pixels (and therefore the OCR
+  cache keys) are the same as the TIFFs'.
+- render_clip() has pdftoppm render just one rectangle of a page.
+  That's much less work when the boxes cover a small part of the
+  page, but poppler's rasteriser doesn't match ghostscript's pixel for
+  pixel.
+
+A PDF page is named '/path/to/school.pdf#N' wherever ocr_pdf.py would
+otherwise use a TIFF filename.
+"""
+
+import os
+import re
+import subprocess
+import Image
+from cStringIO import StringIO
+
+# The config coordinates are in pixels at the resolution
+# pdf-to-tiff.sh renders at.
+DPI = 720
+
+def page_name(pdf, page):
+    """
+    >>> page_name('/path/to/pdf/245-Mojave HS.pdf', 2)
+    '/path/to/pdf/245-Mojave HS.pdf#2'
+    """
+    return '%s#%d' % (pdf, page)
+
+def parse_page_name(name):
+    """
+    Split a PDF page name into (pdf, page), or return None if `name`
+    isn't one.
+    """
+    match = re.search('^(.+\.pdf)#(\d+)$', name)
+    if match:
+        return (match.group(1), int(match.group(2)))
+
+def render_page(pdf, page, dpi=DPI):
+    """
+    Render one page of `pdf` to a grayscale Image with ghostscript.
+    """
+    output = subprocess.check_output([
+        'gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE',
+        '-sDEVICE=pgmraw', '-r%dx%d' % (dpi, dpi),
+        '-dFirstPage=%d' % page, '-dLastPage=%d' % page,
+        '-sOutputFile=-', pdf])
+    return Image.open(StringIO(output))
+
+def render_clip(pdf, page, box, dpi=DPI):
+    """
+    Render just the (x0, y0, x1, y1) pixel rectangle of one page of
+    `pdf` to a grayscale Image with pdftoppm.
+    """
+    (x0, y0, x1, y1) = box
+    output = subprocess.check_output([
+        'pdftoppm', '-gray', '-r', str(dpi),
+        '-f', str(page), '-l', str(page),
+        '-x', str(x0), '-y', str(y0), '-W', str(x1 - x0), '-H', str(y1 - y0),
+        pdf])
+    return Image.open(StringIO(output))
+
+def get_pdf_files(pdf_dir, pages=4):
+    """
+    Like ocr_pdf.get_tiff_files, but for the PDFs themselves.
+
+    >>> result = next(get_pdf_files('pdf/'))
+    >>> result[0]
+    '245-Mojave HS'
+    >>> result[1]
+    {1: '/path/to/pdf/245-Mojave HS.pdf#1', 2: ...}
+    """
+    for fn in sorted(os.listdir(pdf_dir)):
+        if not fn.endswith('.pdf'):
+            continue
+        pdf = os.path.abspath(os.path.join(pdf_dir, fn))
+        yield (fn[:-len('.pdf')], {n: page_name(pdf, n) for n in xrange(1, pages + 1)})
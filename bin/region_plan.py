@@ -0,0 +1,153 @@
+"""
+A config compiled down to what ocr_pdf.py and create_csv.py use.
+
+Every run used to re-parse the .ini with ConfigParser and then, for
+every school, split each section name for its page number and run
+every box through the coords() regex again. A RegionPlan does that
+once: the categories in config order, and for each page its distinct
+boxes (as integer tuples, sorted) along with the categories that read
+each one.
+
+Plans are plain data, so they pickle cheaply for worker processes and
+are cached on disk under PLAN_DIR, keyed by a hash of the config file,
+so an unchanged config is never parsed again.
+"""
+
+import os
+import re
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict
+from configparser import ConfigParser, ExtendedInterpolation
+
+# Where compiled plans are cached; see load_plan.
+PLAN_DIR = '/var/ccsd-scripts/plans'
+
+# Bump when RegionPlan changes shape so stale pickles are ignored.
+PLAN_VERSION = 1
+
+def build_config(config_file):
+    """
+    Build a ConfigParser object.
+
+    Two notes:
+    - Use ExtendedInterpolation
+    - Don't downcase key names
+    """
+    config = ConfigParser(interpolation=ExtendedInterpolation())
+    config.optionxform = lambda opt: opt
+    config.read([config_file])
+    return config
+
+def coords(coord):
+    """
+    Translate (x, y) coordinates along with (width, height)
+    measurements into a box used to crop the TIFF image. A box that's
+    already been translated is returned as is.
+
+    >>> coords('615,158 32,24')
+    (615, 158, 615+32, 158+24)
+    """
+    if isinstance(coord, tuple):
+        return coord
+    x, y, w, h = re.search('^(\d+),(\d+)[ ,](\d+),(\d+)$', coord).groups()
+    x, y, w, h = map(int, [x, y, w, h])
+    return (x, y, x+w, y+h)
+
+def format_coords(box):
+    """
+    The inverse of coords().
+
+    >>> format_coords((615, 158, 647, 182))
+    '615,158 32,24'
+    """
+    if isinstance(box, basestring):
+        return box
+    (x0, y0, x1, y1) = box
+    return '%d,%d %d,%d' % (x0, y0, x1 - x0, y1 - y0)
+
+class RegionPlan(object):
+    """
+    - `entries`: (section, category, page, box) for every category in
+      config order; `box` is None for a deliberately empty column.
+    - `pages`: {page: [(box, [(section, category), ...]), ...]}, each
+      page's distinct boxes in sorted order.
+    - `columns`: {section: [category, ...]} in config order, and
+      `positions`: {section: {category: column}}.
+    - `coordinates`: {section: {category: coordinates}}, as written in
+      the config (for the manifest).
+    """
+    def __init__(self, config):
+        self.entries = []
+        self.columns = OrderedDict()
+        self.positions = {}
+        self.coordinates = OrderedDict()
+        pages = {}
+
+        for section in config.sections():
+            page = int(section.split('-', 1)[0])
+            items = list(config[section].items())
+            self.columns[section] = [category for (category, _) in items]
+            self.positions[section] = {category: n for (n, (category, _))
+                                       in enumerate(items)}
+            self.coordinates[section] = dict(items)
+            for (category, coordinates) in items:
+                box = coords(coordinates) if coordinates != '' else None
+                self.entries.append((section, category, page, box))
+                if box is not None:
+                    pages.setdefault(page, OrderedDict()).setdefault(
+                        box, []).append((section, category))
+
+        self.pages = {page: sorted(boxes.iteritems())
+                      for (page, boxes) in pages.iteritems()}
+
+    def boxes(self, only=None):
+        """
+        Yield (page, box) for every distinct box, page by page. With
+        `only`, just the boxes read by one of those (section,
+        category) pairs.
+        """
+        for page in sorted(self.pages):
+            for (box, categories) in self.pages[page]:
+                if only is None or any(pair in only for pair in categories):
+                    yield (page, box)
+
+    def count_boxes(self):
+        """
+        Return (boxes, unique): how many non-empty boxes a school has
+        and how many distinct (page, box) pairs those come down to.
+        """
+        return (sum(1 for entry in self.entries if entry[3] is not None),
+                sum(len(boxes) for boxes in self.pages.itervalues()))
+
+def plan_path(config_file, plan_dir=PLAN_DIR):
+    with open(config_file, 'rb') as fp:
+        digest = hashlib.sha1('%d\n%s' % (PLAN_VERSION, fp.read())).hexdigest()
+    return os.path.join(plan_dir, digest + '.pickle')
+
+def load_plan(config_file, plan_dir=PLAN_DIR):
+    """
+    Return the RegionPlan for `config_file`, compiling it (and caching
+    it under `plan_dir`, when that's writable) only if the file has
+    changed since it was last compiled.
+    """
+    path = plan_path(config_file, plan_dir)
+    try:
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+
+    plan = RegionPlan(build_config(config_file))
+    try:
+        if not os.path.isdir(plan_dir):
+            os.makedirs(plan_dir)
+        # Pickle to a temp file and rename it into place so concurrent
+        # runs never see a half-written plan.
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickle.dump(plan, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+    return plan
@@ -1,6 +1,23 @@
 import re
+import os
+import csv
+import json
+import random
+import shutil
+import tempfile
+from lxml import etree
 from ConfigParser import SafeConfigParser
-from extract_information import extract_from_pdf
+from extract_information import extract_from_pdf, process_page, create_boundaries
+import create_csv
+import manifest
+import ocr_backend
+from ocr_pdf import plan_schools
+from page_cache import PageCache
+from ocr_cache import SQLiteCache
+from ingest import BulkWriter, document_key
+from region_plan import load_plan, plan_path
+from text_layer import TextLayer
+from benchmark import FakeCollection, make_xml, process_page_scan
 
 ELEMENTARY_SCHOOL_POINTS = {
     'xml/ES/201-Bass, John C ES.xml': {
@@ -451,3 +468,348 @@ def test_middle_school():
     config.read(['ms-config.ini'])
     for fname in MIDDLE_SCHOOL_POINTS.iterkeys():
         yield check_school_values, fname, config
+
+def check_same_matches(fname, config):
+    doc = etree.parse(fname)
+    ret = {}
+    for n in ('1', '2', '3'):
+        page = dict(config=config.items('p' + n),
+                    page=doc.xpath("//page[@id='%s']//textbox" % n))
+        assert process_page(page) == process_page_scan(page), "page %s of %r" % (n, fname)
+        ret.update(process_page(page))
+
+    # The streaming parser should find exactly what the whole tree does.
+    streamed = extract_from_pdf(fname, config)
+    del streamed['School']
+    assert streamed == ret, fname
+
+def test_indexed_matching():
+    for (config_file, points) in [('es-config.ini', ELEMENTARY_SCHOOL_POINTS),
+                                  ('ms-config.ini', MIDDLE_SCHOOL_POINTS)]:
+        school_config = SafeConfigParser()
+        school_config.optionxform = lambda value: value
+        school_config.read([config_file])
+        for fname in points.iterkeys():
+            yield check_same_matches, fname, school_config
+
+def test_boundaries():
+    boundaries = create_boundaries('663.000:10,313.440,699.454,323.989', default_size=5)
+    assert boundaries.match((653.000, 308.000, 694.000, 318.000))
+    assert boundaries.match((673.999, 318.999, 704.999, 328.999))
+    assert not boundaries.match((674.000, 313.440, 699.454, 323.989))
+    assert not boundaries.match((663.000, 307.999, 699.454, 323.989))
+
+def test_fractional_boundaries():
+    boundaries = create_boundaries('663.000:2.5,313.440:0,699.454,323.989')
+    assert boundaries.match((660.500, 313.000, 699.454, 323.989))
+    assert boundaries.match((666.499, 313.999, 699.454, 323.989))
+    assert not boundaries.match((660.499, 313.440, 699.454, 323.989))
+    assert not boundaries.match((663.000, 314.000, 699.454, 323.989))
+
+def test_write_csv_cli():
+    # Parsed the way the Makefile runs create_csv.py.
+    tmp = tempfile.mkdtemp()
+    try:
+        config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'config', 'es.2011-12.ini')
+        output = os.path.join(tmp, 'es.csv')
+        args = create_csv.get_parser().parse_args([
+            '-t', 'Elementary', '-c', config, '-o', output, '-y', '2011-12',
+            '--plan-dir', tmp])
+        plan = create_csv.load_plan(config, tmp)
+        (section, columns) = plan.columns.items()[0]
+
+        collection = FakeCollection()
+        collection.documents['key'] = {
+            'school': {'name': 'Bass, John C ES', 'id': 201, 'type': 'Elementary'},
+            'year': '2011-12', 'section': section,
+            'category': columns[-1], 'value': '69.18'}
+        assert create_csv.write_csv(args, collection=collection) == [output]
+
+        with open(output, 'rb') as fp:
+            rows = list(csv.reader(fp))
+        assert rows[0] == ['School'] + columns
+        assert rows[1] == ['Bass, John C ES'] + [''] * (len(columns) - 1) + ['69.18']
+    finally:
+        shutil.rmtree(tmp)
+
+def manifest_entry(pages, coordinates, settings=None):
+    return {'pages': pages, 'settings': manifest.settings_signature(settings or {}),
+            'sections': manifest.build_sections(coordinates)}
+
+MANIFEST_COORDINATES = {
+    '1-summary': {'Total Score': '100,100 40,20', 'AYP': '100,140 40,20'},
+    '2-growth': {'Math': '200,100 40,20'},
+}
+
+def test_changed_categories():
+    pages = {'1': '100:10', '2': '100:20'}
+    old = manifest_entry(pages, MANIFEST_COORDINATES, {'ocr': 'batch'})
+    everything = set([('1-summary', 'Total Score'), ('1-summary', 'AYP'),
+                      ('2-growth', 'Math')])
+
+    assert manifest.changed_categories(None, old) == everything
+    assert manifest.changed_categories(old, old) == set()
+
+    moved = dict(MANIFEST_COORDINATES, **{
+        '1-summary': {'Total Score': '100,100 40,20', 'AYP': '100,150 40,20'}})
+    new = manifest_entry(pages, moved, {'ocr': 'batch'})
+    assert manifest.changed_categories(old, new) == set([('1-summary', 'AYP')])
+
+    new = manifest_entry(dict(pages, **{'2': '200:20'}), MANIFEST_COORDINATES,
+                         {'ocr': 'batch'})
+    assert manifest.changed_categories(old, new) == set([('2-growth', 'Math')])
+
+    new = manifest_entry(pages, MANIFEST_COORDINATES, {'ocr': 'tesserocr'})
+    assert manifest.changed_categories(old, new) == everything
+
+def test_removed_categories():
+    pages = {'1': '100:10', '2': '100:20'}
+    old = manifest_entry(pages, MANIFEST_COORDINATES)
+    assert manifest.removed_categories(None, old) == set()
+    assert manifest.removed_categories(old, old) == set()
+
+    new = manifest_entry(pages, {'1-summary': {'Total Score': '100,100 40,20'}})
+    assert manifest.removed_categories(old, new) == set([
+        ('1-summary', 'AYP'), ('2-growth', 'Math')])
+
+def test_manifest_stores_sections_once():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'manifest.json')
+        state = manifest.Manifest(path)
+        entries = {}
+        for school in ('201-Bass', '202-Beatty'):
+            entries[school] = manifest_entry({'1': school}, MANIFEST_COORDINATES)
+            state.update(school, entries[school])
+        state.save()
+
+        with open(path) as fp:
+            assert len(json.load(fp)['sections']) == 1
+        state = manifest.Manifest(path)
+        for (school, entry) in entries.iteritems():
+            assert state.get(school) == entry
+        assert state.get('203-Bell') is None
+    finally:
+        shutil.rmtree(tmp)
+
+class FakePlan(object):
+    def __init__(self, columns):
+        self.columns = columns
+        self.positions = {section: {category: n for (n, category) in enumerate(categories)}
+                          for (section, categories) in columns.iteritems()}
+
+def test_make_row_alignment():
+    plan = FakePlan({'1-summary': ['Academic Growth', 'AYP', 'Total Score']})
+    groups = [
+        # Out of config order, and missing AYP.
+        ('1-summary', 'Bass, John C ES', {'Total Score': '69.18',
+                                          'Academic Growth': '31'}),
+        ('1-summary', 'Wolff, Elise L ES', {'AYP': 'No', 'Retired': '1'}),
+        ('2-growth', 'Bass, John C ES', {'Math': '17'}),
+    ]
+    sections = [(section, list(rows)) for (section, rows)
+                in create_csv.iter_sections(groups, plan)]
+    assert sections == [('1-summary', [
+        ['Bass, John C ES', '31', '', '69.18'],
+        ['Wolff, Elise L ES', '', 'No', ''],
+    ])]
+
+def test_text_layer_line_grouping():
+    layer = TextLayer('unused.pdf')
+    # (x0, y0, x1, y1, text) in pixels: '45.2' 100px tall, then a '%'
+    # on the same baseline whose bbox is 110px tall, then a second line.
+    layer.pages = {1: [
+        (130, 200, 160, 300, '.'), (100, 200, 130, 300, '5'),
+        (160, 200, 190, 300, '2'), (70, 200, 100, 300, '4'),
+        (190, 190, 230, 300, '%'),
+        (70, 350, 100, 450, 'N'), (100, 350, 130, 450, 'o'),
+    ]}
+    assert layer.text_in_box(1, (0, 0, 400, 320)) == '45.2%'
+    assert layer.text_in_box(1, (0, 0, 400, 500)) == '45.2% No'
+    assert layer.text_in_box(1, (500, 0, 600, 100)) is None
+
+def test_plan_schools_removes_missing_schools():
+    tmp = tempfile.mkdtemp()
+    try:
+        plan = FakePlan({'1-summary': ['Total Score', 'AYP'], '2-growth': ['Math']})
+        plan.coordinates = MANIFEST_COORDINATES
+        state = manifest.Manifest(os.path.join(tmp, 'manifest.json'))
+        for school in ('201-Bass', '202-Beatty'):
+            state.update(school, manifest_entry({'1': None, '2': None},
+                                                MANIFEST_COORDINATES))
+
+        # With -s, the schools that weren't asked for are left alone.
+        (work, removed, entries) = plan_schools(
+            plan, [('201-Bass', {1: 'missing', 2: 'missing'})], state, '2011-12',
+            school_ids=['201'])
+        assert removed == []
+        assert sorted(state.schools) == ['201-Bass', '202-Beatty']
+
+        (work, removed, entries) = plan_schools(
+            plan, [('201-Bass', {1: 'missing', 2: 'missing'})], state, '2011-12')
+        assert work == [] and entries.keys() == ['201-Bass']
+        assert sorted(state.schools) == ['201-Bass']
+        assert sorted((key['school.id'], key['section'], key['category'])
+                      for key in removed) == [(202, '1-summary', 'AYP'),
+                                              (202, '1-summary', 'Total Score'),
+                                              (202, '2-growth', 'Math')]
+        assert all(key['year'] == '2011-12' for key in removed)
+    finally:
+        shutil.rmtree(tmp)
+
+def check_montage(regions, hocr, **kwargs):
+    # Stands in for tesseract: returns `hocr` and records each montage.
+    montages = []
+    def run_tesseract(image, psm=7, config=None, data=None):
+        montages.append(image)
+        return hocr
+    backend = ocr_backend.MontageBackend(**kwargs)
+    original = ocr_backend.run_tesseract
+    ocr_backend.run_tesseract = run_tesseract
+    try:
+        return (backend.ocr(regions), montages)
+    finally:
+        ocr_backend.run_tesseract = original
+
+def hocr_word(x0, y0, x1, y1, text):
+    return "<span class='ocrx_word' title='bbox %d %d %d %d; x_wconf 90'>%s</span>" % (
+        x0, y0, x1, y1, text)
+
+def test_montage_rows():
+    import Image
+    regions = [Image.new('L', (60, height), 255) for height in (20, 30, 20)]
+    # A 30px gap (the tallest region) above each row puts the rows at
+    # y=30, 80 and 140; each row starts halfway into the gap above it.
+    hocr = ''.join([
+        hocr_word(20, 30, 50, 50, '12.9'),
+        hocr_word(60, 82, 90, 108, 'No'),
+        hocr_word(20, 82, 50, 108, 'Yes'),
+    ])
+    (texts, montages) = check_montage(regions, hocr, margin=20)
+    assert texts == ['12.9', 'Yes No', '']
+    assert len(montages) == 1 and montages[0].size == (100, 190)
+
+def test_montage_chunks():
+    import Image
+    # One tall region makes every gap in its montage tall.
+    regions = [Image.new('L', (60, 200), 255)] + [
+        Image.new('L', (60, 20), 255) for _ in xrange(12)]
+    (texts, montages) = check_montage(regions, '', margin=20, max_height=1000)
+    assert texts == [''] * len(regions)
+    assert len(montages) > 1
+    assert all(montage.size[1] <= 1000 for montage in montages)
+
+def test_matching_synthetic_pages():
+    # Crowded pages of jiggled boxes, where several locations' windows
+    # overlap, offline.
+    tmp = tempfile.mkdtemp()
+    try:
+        (config, fnames) = make_xml(tmp, 3, 300, random.Random(0))
+        for fname in fnames:
+            doc = etree.parse(fname)
+            for n in ('1', '2', '3'):
+                page = dict(config=config.items('p' + n),
+                            page=doc.xpath("//page[@id='%s']//textbox" % n))
+                assert process_page(page) == process_page_scan(page), (fname, n)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_page_cache():
+    # Pages are strings here, and a page's size is its length.
+    cache = PageCache(max_bytes=10, loader=lambda key: key, sizer=len)
+    cache.get('aaaa')
+    cache.get('bbbb')
+    cache.get('aaaa')
+    # Over budget: the least recently used page goes.
+    cache.get('cccc')
+    assert cache.pages.keys() == ['aaaa', 'cccc']
+    assert cache.bytes == 8
+
+    # A page bigger than the whole budget is still kept.
+    cache.get('d' * 20)
+    assert cache.pages.keys() == ['d' * 20]
+    assert cache.stats() == {'page_decodes': 4, 'page_cache_hits': 1,
+                             'page_cache_bytes': 20, 'page_cache_peak_bytes': 20}
+
+def test_sqlite_cache_chunks():
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = SQLiteCache(os.path.join(tmp, 'ocr.sqlite'))
+        # More keys than fit in one query's bound parameters.
+        mapping = {'ocr:%04d' % n: str(n) for n in xrange(1200)}
+        cache.set_many(mapping)
+        cache.set_many({'ocr:0000': 'O'})
+        mapping['ocr:0000'] = 'O'
+
+        keys = sorted(mapping) + ['ocr:missing']
+        assert len(keys) > 2 * SQLiteCache.CHUNK_SIZE
+        assert cache.get_many(keys) == mapping
+        assert cache.get_many([]) == {}
+    finally:
+        shutil.rmtree(tmp)
+
+def bulk_document(school_id, category, value):
+    return {'school': {'name': 'School %d' % school_id, 'id': school_id,
+                       'type': 'High'},
+            'year': '2011-12', 'section': '1-summary',
+            'category': category, 'value': value}
+
+def test_bulk_writer():
+    collection = FakeCollection()
+    with BulkWriter(collection, batch_size=2) as writer:
+        writer.extend([bulk_document(201, 'AYP', 'No'),
+                       bulk_document(201, 'Total Score', '69.18'),
+                       bulk_document(202, 'AYP', 'Yes')])
+    assert writer.written == 3 and len(collection.documents) == 3
+
+    # Upserting the same key replaces the document; removes and
+    # upserts can share a batch.
+    with BulkWriter(collection, batch_size=2) as writer:
+        writer.add(bulk_document(201, 'AYP', 'Yes'))
+        writer.remove(document_key(bulk_document(202, 'AYP', None)))
+        writer.add(bulk_document(202, 'Total Score', '71.02'))
+    assert writer.written == 3
+    values = sorted((document['school']['id'], document['category'], document['value'])
+                    for document in collection.documents.itervalues())
+    assert values == [(201, 'AYP', 'Yes'), (201, 'Total Score', '69.18'),
+                      (202, 'Total Score', '71.02')]
+
+REGION_PLAN_CONFIG = """\
+[1-summary]
+Total Score = 100,100 40,20
+AYP = 100,140 40,20
+Total = ${Total Score}
+Blank =
+
+[2-growth]
+Math = 200,100 40,20
+"""
+
+def test_region_plan():
+    tmp = tempfile.mkdtemp()
+    try:
+        config = os.path.join(tmp, 'hs.2011-12.ini')
+        with open(config, 'w') as fp:
+            fp.write(REGION_PLAN_CONFIG)
+        plan = load_plan(config, tmp)
+
+        assert plan.columns.items() == [('1-summary', ['Total Score', 'AYP', 'Total', 'Blank']),
+                                        ('2-growth', ['Math'])]
+        assert ('1-summary', 'Blank', 1, None) in plan.entries
+        # Total reads the same box as Total Score, so it's one box.
+        assert plan.pages[1] == [
+            ((100, 100, 140, 120), [('1-summary', 'Total Score'), ('1-summary', 'Total')]),
+            ((100, 140, 140, 160), [('1-summary', 'AYP')]),
+        ]
+        assert plan.count_boxes() == (4, 3)
+        assert list(plan.boxes(set([('2-growth', 'Math')]))) == [(2, (200, 100, 240, 120))]
+
+        path = plan_path(config, tmp)
+        assert os.path.exists(path)
+        with open(config, 'a') as fp:
+            fp.write('Reading = 200,140 40,20\n')
+        assert plan_path(config, tmp) != path
+        assert load_plan(config, tmp).columns['2-growth'] == ['Math', 'Reading']
+    finally:
+        shutil.rmtree(tmp)
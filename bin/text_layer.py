@@ -0,0 +1,111 @@
+"""
+Read values straight out of a PDF's text layer.
+
+The SPF PDFs are generated, not scanned, so most boxes we OCR already
+exist as text (extract_information.py relies on this). TextLayer pulls
+every character and its position out of a PDF with pdfminer, maps it
+from PDF points to the 720 dpi pixel space the ocr configs use, and
+hands back whatever text falls inside a box. ocr_pdf.py only
+rasterises and OCRs the boxes this comes up empty for.
+"""
+
+from ocr_backend import clean_text
+from rasterise import DPI
+
+# PDF user space is 72 points to the inch.
+SCALE = DPI / 72.0
+
+def iter_chars(item):
+    from pdfminer.layout import LTChar, LTContainer
+    if isinstance(item, LTChar):
+        yield item
+    elif isinstance(item, LTContainer):
+        for child in item:
+            for char in iter_chars(child):
+                yield char
+
+def group_lines(chars):
+    """
+    Group characters into lines, top to bottom, each sorted left to
+    right. A character belongs to a line when their vertical spans
+    overlap by at least half of the shorter one, so a taller glyph
+    (a '%', or a bracket) on the same baseline stays on its line.
+    """
+    lines = []
+    for char in sorted(chars, key=lambda char: (char[1] + char[3]) / 2):
+        if lines:
+            (top, bottom, line) = lines[-1]
+            overlap = min(bottom, char[3]) - max(top, char[1])
+            if overlap >= min(bottom - top, char[3] - char[1]) / 2:
+                lines[-1] = (min(top, char[1]), max(bottom, char[3]), line)
+                line.append(char)
+                continue
+        lines.append((char[1], char[3], [char]))
+    return [sorted(members, key=lambda char: char[0]) for (_, _, members) in lines]
+
+class TextLayer(object):
+    """
+    The characters on each page of a PDF, in pixel coordinates.
+
+    Pages are parsed the first time they're asked for.
+    """
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.pages = None
+
+    def load(self):
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+        from pdfminer.converter import PDFPageAggregator
+
+        self.pages = {}
+        manager = PDFResourceManager()
+        # No LAParams: we want the raw characters, not pdfminer's idea
+        # of lines and boxes, and skipping layout analysis is faster.
+        device = PDFPageAggregator(manager)
+        interpreter = PDFPageInterpreter(manager, device)
+
+        with open(self.pdf, 'rb') as fp:
+            for (n, page) in enumerate(PDFPage.get_pages(fp), 1):
+                interpreter.process_page(page)
+                layout = device.get_result()
+                (left, _, _, top) = layout.bbox
+                chars = []
+                for char in iter_chars(layout):
+                    (x0, y0, x1, y1) = char.bbox
+                    chars.append(((x0 - left) * SCALE, (top - y1) * SCALE,
+                                  (x1 - left) * SCALE, (top - y0) * SCALE,
+                                  char.get_text()))
+                self.pages[n] = chars
+
+    def text_in_box(self, page, box):
+        """
+        Return the text whose characters are centred inside the
+        (x0, y0, x1, y1) pixel box on `page`, or None when there isn't
+        any.
+        """
+        if self.pages is None:
+            self.load()
+
+        (bx0, by0, bx1, by1) = box
+        chars = [char for char in self.pages.get(page, [])
+                 if bx0 <= (char[0] + char[2]) / 2 <= bx1
+                 and by0 <= (char[1] + char[3]) / 2 <= by1]
+        if not chars:
+            return None
+
+        # Read top to bottom, then left to right, putting a space
+        # between lines and wherever the gap between two characters is
+        # wider than a quarter of their height.
+        words = []
+        for line in group_lines(chars):
+            text = line[0][4]
+            for (previous, char) in zip(line, line[1:]):
+                if char[0] - previous[2] > (char[3] - char[1]) / 4:
+                    text += ' '
+                text += char[4]
+            words.append(text)
+        text = ' '.join(words)
+
+        text = text.encode('utf-8') if isinstance(text, unicode) else text
+        return clean_text(text) or None